@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014  Regents of the University of California
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of certificate issuing by ndnop-process-requests --auto-approve.
+#
+# ndnsec-certgen is replaced by a stub that takes --certgen-delay seconds, as the real
+# one does to open the TPM and sign, so that only the scheduling of issuing by the
+# script is measured.  The last case signs with --in-process, with keys in memory.
+# Nothing is sent to the server or published.
+#
+#   python3 bench/issue.py -n 200 --jobs 1 2 4 8
+
+import argparse
+import base64
+import concurrent.futures
+import importlib.machinery
+import os
+import stat
+import sys
+import tempfile
+import time
+
+import pyndn as ndn
+from pyndn.security import KeyChain
+from pyndn.security.identity import IdentityManager, MemoryIdentityStorage, MemoryPrivateKeyStorage
+from pyndn.security.policy import NoVerifyPolicyManager
+
+BASEDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+parser = argparse.ArgumentParser(description='Measure certificate issuing throughput of ndnop-process-requests')
+parser.add_argument('-n', '--requests', type=int, default=100, help='''Number of requests to issue per case''')
+parser.add_argument('--jobs', type=int, nargs='+', default=[1, 2, 4, 8], help='''Values of --jobs to compare''')
+parser.add_argument('--certgen-delay', type=float, default=0.05,
+                    help='''Seconds taken by each call of the stub ndnsec-certgen''')
+
+args = parser.parse_args()
+
+SITE_PREFIX = '/ndn/edu/bench'
+
+def loadScript(argv):
+    """Load ndnop-process-requests as a module, as if run with the arguments"""
+    savedArgv = sys.argv
+    sys.argv = ['ndnop-process-requests'] + argv
+    try:
+        loader = importlib.machinery.SourceFileLoader('ndnop_process_requests',
+                                                      os.path.join(BASEDIR, 'ndnop-process-requests'))
+        return loader.load_module()
+    finally:
+        sys.argv = savedArgv
+
+def installStubCertgen(directory):
+    """Put a stub ndnsec-certgen first on PATH"""
+    path = os.path.join(directory, 'ndnsec-certgen')
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\ncat > /dev/null\nsleep %s\necho Q0VSVA==\n' % args.certgen_delay)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    os.environ['PATH'] = directory + os.pathsep + os.environ['PATH']
+
+def makeRequests(keyChain, count):
+    """Return pending requests as parsed by Signer.selectRequests, (request, decoded request)"""
+    # requests differ only in the user data, the key of one certification request will do
+    certName = keyChain.createIdentityAndCertificate(ndn.Name(SITE_PREFIX).append('user'))
+    wire = keyChain.getIdentityManager().getCertificate(certName).wireEncode().toBytes()
+    return [({'_id': {'$oid': '%024x' % i},
+              'cert_request': {'$binary': base64.b64encode(wire).decode('ascii')},
+              'fullname': 'User %d' % i, 'organization': 'Bench', 'email': 'user%d@bench.edu' % i,
+              'homeurl': '', 'group': '', 'advisor': ''}, None) for i in range(count)]
+
+def issueAll(script, signer, pending, jobs, inProcess):
+    """Return seconds to issue certificates for all pending requests"""
+    script.args.jobs = jobs
+    script.args.in_process = inProcess
+    executor = None if inProcess else concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    started = time.perf_counter()
+    try:
+        for req, certData, (cert, error) in signer.issueAhead(pending, executor):
+            if error != None:
+                raise error
+    finally:
+        if executor != None:
+            executor.shutdown()
+    return time.perf_counter() - started
+
+def main():
+    script = loadScript(['--auto-approve', SITE_PREFIX])
+    signer = script.Signer(ndn.Name(SITE_PREFIX))
+    signer.keyChain = KeyChain(IdentityManager(MemoryIdentityStorage(), MemoryPrivateKeyStorage()),
+                               NoVerifyPolicyManager())
+    signer.certName = signer.keyChain.createIdentityAndCertificate(ndn.Name(SITE_PREFIX))
+    pending = makeRequests(signer.keyChain, args.requests)
+
+    with tempfile.TemporaryDirectory() as directory:
+        installStubCertgen(directory)
+        print("%-12s %12s %10s" % ("jobs", "certs/s", "speedup"))
+        base = None
+        for jobs in args.jobs:
+            rate = args.requests / issueAll(script, signer, pending, jobs, False)
+            base = base or rate
+            print("%-12d %12.1f %9.2fx" % (jobs, rate, rate / base))
+
+        rate = args.requests / issueAll(script, signer, pending, 1, True)
+        print("%-12s %12.1f %9.2fx" % ("in-process", rate, rate / base))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014  Regents of the University of California
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Microbenchmarks of in-memory structures of the web server, which need no database.
+#
+#   python3 bench/micro.py            # all benchmarks
+#   python3 bench/micro.py trie
+
+import argparse
+import os
+import sys
+import time
+
+BASEDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if BASEDIR not in sys.path:
+    sys.path.append(BASEDIR)
+
+from www.operator_cache import DomainTrie
+from www.replay_guard import ReplayGuard
+
+parser = argparse.ArgumentParser(description='Run microbenchmarks of ndncert web server structures')
+parser.add_argument('benchmarks', metavar='benchmark', nargs='*',
+                    help='''Benchmarks to run (all by default)''')
+parser.add_argument('-n', '--iterations', type=int, default=200000, help='''Timed operations per case''')
+
+args = parser.parse_args()
+
+def timePerCall(f, count):
+    """Return seconds per call of f(i) for i in range(count)"""
+    started = time.perf_counter()
+    for i in range(count):
+        f(i)
+    return (time.perf_counter() - started) / count
+
+def benchTrie():
+    """Domain lookup cost by the number of registered domains (should stay flat)"""
+    print("%-10s %12s %12s %12s" % ("domains", "exact ns", "subdomain ns", "miss ns"))
+    for size in (10, 100, 1000, 10000, 100000):
+        trie = DomainTrie()
+        for i in range(size):
+            trie.insert('site%d.edu' % i, i, subdomains=(i % 2 == 0))
+
+        exact = ['site%d.edu' % (i * 7919 % size) for i in range(1000)]
+        subdomain = ['cs.dept.site%d.edu' % (i * 7919 % size // 2 * 2) for i in range(1000)]
+        miss = ['cs.unknown%d.org' % i for i in range(1000)]
+        print("%-10d %12.0f %12.0f %12.0f" % (size,
+              timePerCall(lambda i: trie.lookup(exact[i % 1000]), args.iterations) * 1e9,
+              timePerCall(lambda i: trie.lookup(subdomain[i % 1000]), args.iterations) * 1e9,
+              timePerCall(lambda i: trie.lookup(miss[i % 1000]), args.iterations) * 1e9))
+
+def benchReplayGuard():
+    """Cost of rejecting stale and replayed command interests, by the number of remembered signatures"""
+    print("%-10s %12s %12s %12s" % ("seen", "stale ns", "replay ns", "accept ns"))
+    for size in (1000, 10000, 100000):
+        guard = ReplayGuard(window=15 * 3600, maxsize=size)
+        now = time.time()
+        for i in range(size):
+            guard.record('/ndn/edu/site%d' % (i % 100), now, 'digest%d' % i)
+
+        seen = ['digest%d' % (i * 7919 % size) for i in range(1000)]
+        print("%-10d %12.0f %12.0f %12.0f" % (size,
+              timePerCall(lambda i: guard.check('/ndn/edu/site1', now - 86400, 'new%d' % i), args.iterations) * 1e9,
+              timePerCall(lambda i: guard.check('/ndn/edu/site1', now, seen[i % 1000]), args.iterations) * 1e9,
+              timePerCall(lambda i: guard.check('/ndn/edu/site1', now, 'new%d' % i), args.iterations) * 1e9))
+
+BENCHMARKS = [
+    ('trie', benchTrie),
+    ('replay-guard', benchReplayGuard),
+    ]
+
+def main():
+    for name, bench in BENCHMARKS:
+        if args.benchmarks and name not in args.benchmarks:
+            continue
+        print("== %s: %s" % (name, bench.__doc__))
+        bench()
+        print("")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2014  Regents of the University of California
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of the web server routes.
+#
+# The app is driven through the Flask test client, against a scratch database of a
+# local mongod (or mongomock with --mongomock), seeded with operators, certificates
+# and certification requests.  Email messages are only queued in the outbox.
+#
+#   python3 bench/run.py --certs 100000 --output before.json
+#   python3 bench/run.py --certs 100000 --baseline before.json
+#   python3 bench/run.py --requests 10000 --memory
+#   python3 bench/run.py --certs 100000 --legacy-operator-copy --output legacy.json
+
+import argparse
+import base64
+import concurrent.futures
+import datetime
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+BASEDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if BASEDIR not in sys.path:
+    sys.path.append(BASEDIR)
+
+import bson
+from bson import json_util
+from bson.binary import Binary
+import pyndn as ndn
+from pyndn.security import KeyChain
+from pyndn.security.identity import IdentityManager, MemoryIdentityStorage, MemoryPrivateKeyStorage
+from pyndn.security.policy import NoVerifyPolicyManager
+
+parser = argparse.ArgumentParser(description='Measure throughput and latency of ndncert web server routes')
+parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/ndncert_bench',
+                    help='''Database to run against; it is DROPPED and seeded on start''')
+parser.add_argument('--mongomock', action='store_true',
+                    help='''Use in-memory mongomock instead of mongod (latencies are not representative)''')
+parser.add_argument('--operators', type=int, default=10, help='''Number of operators (sites)''')
+parser.add_argument('--certs', type=int, default=1000, help='''Number of issued certificates''')
+parser.add_argument('--requests', type=int, default=1000, help='''Number of pending certification requests''')
+parser.add_argument('--distinct-certs', type=int, default=32,
+                    help='''Number of distinct certificate encodings the seeded records are made of''')
+parser.add_argument('-n', '--iterations', type=int, default=200, help='''Timed calls of each route''')
+parser.add_argument('--warmup', type=int, default=10, help='''Untimed calls of each route''')
+parser.add_argument('--threads', type=int, default=8,
+                    help='''Concurrent clients of the token benchmarks marked as concurrent''')
+parser.add_argument('--only', metavar='ROUTE', action='append',
+                    help='''Run only the named benchmark (can be repeated)''')
+parser.add_argument('--output', help='''Save results as JSON''')
+parser.add_argument('--baseline', help='''Compare with results saved by --output, exit with 1 on regression''')
+parser.add_argument('--tolerance', type=float, default=0.2,
+                    help='''Allowed relative increase of p50 latency over the baseline''')
+parser.add_argument('--legacy-operator-copy', action='store_true',
+                    help='''Also store a copy of the operator record in each certificate, as older versions did''')
+parser.add_argument('--memory', action='store_true',
+                    help='''Measure peak memory of listing pending requests instead of latencies''')
+
+args = parser.parse_args()
+
+SEED_BATCH_SIZE = 10000
+ADMIN_USERNAME = ADMIN_PASSWORD = 'bench'
+
+def makeKeyChain():
+    return KeyChain(IdentityManager(MemoryIdentityStorage(), MemoryPrivateKeyStorage()),
+                    NoVerifyPolicyManager())
+
+def makeCertificate(keyChain, identity):
+    """Return (certificate name, wire encoding) of new self-signed certificate of the identity"""
+    certName = keyChain.createIdentityAndCertificate(ndn.Name(identity))
+    cert = keyChain.getIdentityManager().getCertificate(certName)
+    return certName, cert.wireEncode().toBytes()
+
+def configure():
+    """Point the app to the benchmark database before it is imported"""
+    settings = tempfile.NamedTemporaryFile('w', suffix='.py', delete=False)
+    dbname = args.mongo_uri.rsplit('/', 1)[-1].split('?')[0]
+    settings.write('MONGO_URI = %r\n' % args.mongo_uri)
+    settings.write('MONGO_DBNAME = %r\n' % dbname)
+    settings.write('MAIL_SUPPRESS_SEND = True\n')
+    settings.write('ENSURE_INDEXES_ON_STARTUP = False\n')
+    # every request comes from the same client address
+    settings.write('RATE_LIMITS = {}\n')
+    settings.write('ADMIN_USERNAME = %r\n' % ADMIN_USERNAME)
+    settings.write('ADMIN_PASSWORD = %r\n' % hashlib.sha256(ADMIN_PASSWORD.encode('utf-8')).hexdigest())
+    settings.close()
+    os.environ['NDNCERT_SETTINGS'] = settings.name
+
+def seed(server):
+    mongo = server.mongo
+    mongo.db.client.drop_database(mongo.db.name)
+    now = datetime.datetime.utcnow()
+
+    print("Generating keys...")
+    keyChain = makeKeyChain()
+    operators = []
+    for i in range(args.operators):
+        site_prefix = '/ndn/edu/site%d' % i
+        certName, wire = makeCertificate(keyChain, site_prefix)
+        operators.append({
+            'site_prefix': site_prefix,
+            'site_name': 'Site %d' % i,
+            'site_emails': ['site%d.edu' % i],
+            'name': 'Operator %d' % i,
+            'email': 'operator@site%d.edu' % i,
+            'allowGuests': True,
+            'doNotSendOpRequestsForGuests': False,
+            'doNotSendOpRequests': False,
+            'key': base64.b64encode(wire).decode('ascii'),
+            'certName': certName,
+            })
+    pool = [makeCertificate(keyChain, '/ndn/edu/site0/pool%d' % i)[1] for i in range(args.distinct_certs)]
+
+    print("Seeding %d operators, %d certificates, %d requests..." % (args.operators, args.certs, args.requests))
+    for operator in operators:
+        certName = operator.pop('certName')
+        mongo.db.operators.insert(operator)
+        operator['certName'] = certName
+
+    validity = dict(zip(('not_before', 'not_after'),
+                        server.get_validity(server.decode_certificate(pool[0]))))
+    def certs():
+        for i in range(args.certs):
+            operator = operators[i % len(operators)]
+            doc = {
+                'name': '%s/user%d/KSK-%d/ID-CERT/%%FD%%01' % (operator['site_prefix'], i, i),
+                'cert': Binary(pool[i % len(pool)]),
+                'operator_id': str(operator['_id']),
+                'site_prefix': operator['site_prefix'],
+                'site_name': operator['site_name'],
+                'created_on': now,
+                }
+            doc.update(validity)
+            if args.legacy_operator_copy:
+                doc['operator'] = dict((k, v) for k, v in operator.items() if k != 'certName')
+            yield doc
+    insertBatches(mongo.db.certs, certs())
+
+    def requests():
+        for i in range(args.requests):
+            operator = operators[i % len(operators)]
+            yield {
+                'operator_id': str(operator['_id']),
+                'site_prefix': operator['site_prefix'] if i % 2 else '',
+                'assigned_namespace': '%s/user%d' % (operator['site_prefix'], i),
+                'fullname': 'User %d' % i,
+                'organization': operator['site_name'],
+                'email': 'user%d@site%d.edu' % (i, i % len(operators)),
+                'homeurl': '', 'group': '', 'advisor': '',
+                'cert_request': Binary(pool[i % len(pool)]),
+                'created_on': now - datetime.timedelta(seconds=args.requests - i),
+                }
+    insertBatches(mongo.db.requests, requests())
+
+    server.ensure_indexes()
+    server.operators.invalidate()
+    return keyChain, operators
+
+def storageSize(collection):
+    """Return (number of documents, sum of their BSON sizes)"""
+    count = size = 0
+    for doc in collection.find():
+        count += 1
+        size += len(bson.encode(doc))
+    return count, size
+
+def insertBatches(collection, docs):
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) == SEED_BATCH_SIZE:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+
+def signCommandInterests(keyChain, operator, command, count):
+    """Return base64-encoded names of signed command interests, as made by ndnop-process-requests"""
+    # each interest needs a new timestamp (ms), otherwise its signature would be a replay
+    now = int(time.time() * 1000)
+    interests = []
+    for i in range(count):
+        name = ndn.Name(command).append(str(now + i)).append(ndn.Name(operator['site_prefix']).wireEncode())
+        interest = ndn.Interest(name)
+        keyChain.sign(interest, operator['certName'])
+        interests.append(base64.b64encode(interest.getName().wireEncode().toBuffer()))
+    return interests
+
+def makeBenchmarks(server, keyChain, operators):
+    """Return [(benchmark name, function making one call with the test client, number of threads)]"""
+    client = server.app.test_client()
+    local = threading.local()
+    def threadClient():
+        if not hasattr(local, 'client'):
+            local.client = server.app.test_client()
+        return local.client
+    operator = operators[0]
+    certName = server.mongo.db.certs.find_one({'operator_id': str(operator['_id'])})['name']
+
+    # users of the first site, with certification requests for their namespaces
+    with server.app.app_context():
+        users = []
+        for i in range(4):
+            email = 'bench%d@site0.edu' % i
+            namespace = server.get_operator_for_email(email)['assigned_namespace']
+            users.append((email, base64.b64encode(makeCertificate(keyChain, namespace.toUri())[1])))
+
+    commandInterests = iter(signCommandInterests(keyChain, operator, '/cert-requests/get',
+                                                 args.warmup + args.iterations))
+    adminAuth = 'Basic ' + base64.b64encode(('%s:%s' % (ADMIN_USERNAME, ADMIN_PASSWORD)).encode('ascii')) \
+        .decode('ascii')
+
+    # tokens as sent by email, valid until used
+    tokens = []
+    for i in range(64):
+        email = 'bench%d@site0.edu' % (i % 4)
+        token = server.generate_token()
+        server.mongo.db.tokens.insert({'email': email, 'token_hash': server.hash_token(token),
+                                       'site_prefix': '', 'created_on': datetime.datetime.utcnow()})
+        tokens.append({'email': email, 'token': token})
+    def validateToken(i=[0]):
+        i[0] += 1
+        return threadClient().get('/cert-requests/submit/', query_string=tokens[i[0] % len(tokens)])
+
+    def submitRequest(i=[0]):
+        # token as sent by email, issued directly to leave the mail out of the measurement
+        email, certRequest = users[i[0] % len(users)]
+        i[0] += 1
+        token = server.generate_token()
+        server.mongo.db.tokens.insert({'email': email, 'token_hash': server.hash_token(token),
+                                       'site_prefix': '', 'created_on': datetime.datetime.utcnow()})
+        client.get('/cert-requests/submit/', query_string={'email': email, 'token': token})
+        return client.post('/cert-requests/submit/', data={'email': email, 'token': token,
+                                                           'fullname': 'Bench User',
+                                                           'cert-request': certRequest})
+
+    return [
+        ('cert-list', lambda: client.get('/cert/list/'), 1),
+        ('cert-list-html', lambda: client.get('/cert/list/html'), 1),
+        ('cert-list-admin', lambda: client.get('/cert/list/admin', headers={'Authorization': adminAuth}), 1),
+        ('cert-get', lambda: client.get('/cert/get/', query_string={'name': certName}), 1),
+        ('cert-get-view', lambda: client.get('/cert/get/', query_string={'name': certName, 'view': 1}), 1),
+        ('token-request', lambda: client.post('/tokens/request/', data={'email': 'bench@site0.edu',
+                                                                        'site': ''}), 1),
+        ('token-request-concurrent', lambda: threadClient().post('/tokens/request/',
+                                                                 data={'email': 'bench@site0.edu', 'site': ''}),
+         args.threads),
+        ('token-validate-concurrent', validateToken, args.threads),
+        ('request-submit', submitRequest, 1),
+        ('cert-requests-get', lambda: client.post('/cert-requests/get/',
+                                                  data={'commandInterest': next(commandInterests),
+                                                        'format': 'ndjson'}), 1),
+        ]
+
+def peakMemory(f):
+    """Return peak bytes allocated while f() runs"""
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def measureMemory(server, keyChain, operators):
+    """Print peak memory of encoding and parsing all pending requests of one operator"""
+    client = server.app.test_client()
+    operator = operators[0]
+    commandInterests = iter(signCommandInterests(keyChain, operator, '/cert-requests/get', 3))
+    def post(format):
+        return client.post('/cert-requests/get/', data={'commandInterest': next(commandInterests),
+                                                        'format': format})
+
+    def streamed():
+        # chunks are dropped as they are sent
+        for chunk in post('ndjson').iter_encoded():
+            pass
+
+    def materialized():
+        # the whole cursor and its encoding at once, as done before responses were streamed
+        json.dumps(list(server.mongo.db.requests.find({'operator_id': str(operator['_id'])})
+                        .sort([('created_on', 1)])), default=json_util.default)
+
+    ndjson = post('ndjson').get_data()
+    array = post('json').get_data()
+    count = ndjson.count(b'\n')
+
+    print("%d requests of the operator, %d KiB of NDJSON" % (count, len(ndjson) // 1024))
+    if args.mongomock:
+        print("(mongomock copies all matching documents when the cursor is opened)")
+    print("%-46s %12s" % ("case", "peak KiB"))
+    for name, f in [
+            ('server: streamed NDJSON response', streamed),
+            ('server: whole list encoded at once', materialized),
+            # body as received, parsing as done by ndnop-process-requests
+            ('client: NDJSON parsed line by line', lambda: [json.loads(line) for line in io.BytesIO(ndjson)]),
+            ('client: whole JSON array parsed at once', lambda: json.loads(array.decode('utf-8'))),
+            ]:
+        print("%-46s %12.0f" % (name, peakMemory(f) / 1024))
+
+def measure(call, threads=1):
+    for i in range(args.warmup):
+        call()
+
+    def timedCall(i):
+        callStarted = time.perf_counter()
+        response = call()
+        response.get_data() # consume streamed responses
+        if response.status_code >= 400:
+            raise RuntimeError("unexpected status %d" % response.status_code)
+        return time.perf_counter() - callStarted
+
+    started = time.perf_counter()
+    if threads == 1:
+        latencies = [timedCall(i) for i in range(args.iterations)]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            latencies = list(executor.map(timedCall, range(args.iterations)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'throughput': args.iterations / elapsed,
+        'p50': latencies[len(latencies) // 2],
+        'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        }
+
+def compare(results, baseline):
+    """Print p50 changes against the baseline, return True if any route got slower than allowed"""
+    regressed = False
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = result['p50'] / baseline[name]['p50'] - 1
+        slower = change > args.tolerance
+        regressed = regressed or slower
+        print("%-26s p50 %+6.1f%%%s" % (name, change * 100, "  REGRESSION" if slower else ""))
+    return regressed
+
+def main():
+    configure()
+    from www import server
+
+    if args.mongomock:
+        # the client of the app is created on import, but does not connect until used
+        import mongomock
+        server.mongo.cx = mongomock.MongoClient()
+        server.mongo.db = server.mongo.cx[server.mongo.db.name]
+
+    results = {}
+    with server.app.app_context():
+        keyChain, operators = seed(server)
+        if args.memory:
+            measureMemory(server, keyChain, operators)
+            return
+
+        count, size = storageSize(server.mongo.db.certs)
+        storage = {'certs': size}
+        print("certs: %d documents, %.0f KiB of BSON (%.0f bytes per certificate)" % \
+              (count, size / 1024, size / max(count, 1)))
+
+        print("%-26s %10s %10s %10s" % ("benchmark", "req/s", "p50 ms", "p99 ms"))
+        for name, call, threads in makeBenchmarks(server, keyChain, operators):
+            if args.only and name not in args.only:
+                continue
+            result = results[name] = measure(call, threads)
+            print("%-26s %10.1f %10.2f %10.2f" % (name, result['throughput'],
+                                                   result['p50'] * 1000, result['p99'] * 1000))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'params': vars(args), 'storage': storage, 'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            if compare(results, json.load(f)['results']):
+                sys.exit(1)
+
+if __name__ == "__main__":
+    main()
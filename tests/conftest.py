@@ -0,0 +1,80 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+BASEDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if BASEDIR not in sys.path:
+    sys.path.append(BASEDIR)
+
+@pytest.fixture(scope='session')
+def server():
+    """The web server app, with its database replaced by an in-memory mongomock database"""
+    mongomock = pytest.importorskip('mongomock')
+
+    settings = tempfile.NamedTemporaryFile('w', suffix='.py', delete=False)
+    settings.write("MONGO_URI = 'mongodb://localhost:27017/ndncert_test'\n")
+    settings.write("MAIL_SUPPRESS_SEND = True\n")
+    settings.write("ENSURE_INDEXES_ON_STARTUP = False\n")
+    settings.write("RATE_LIMITS = {}\n")
+    settings.close()
+    os.environ['NDNCERT_SETTINGS'] = settings.name
+
+    from www import server
+    server.mongo.cx = mongomock.MongoClient()
+    server.mongo.db = server.mongo.cx['ndncert_test']
+    yield server
+    os.unlink(settings.name)
+
+@pytest.fixture
+def db(server):
+    """Empty database of the app, in app context"""
+    with server.app.app_context():
+        server.mongo.cx.drop_database('ndncert_test')
+        server.operators.invalidate()
+        yield server.mongo.db
+
+@pytest.fixture(scope='session')
+def keyChain():
+    """KeyChain with in-memory identity and key storage"""
+    from pyndn.security import KeyChain
+    from pyndn.security.identity import IdentityManager, MemoryIdentityStorage, MemoryPrivateKeyStorage
+    from pyndn.security.policy import NoVerifyPolicyManager
+    return KeyChain(IdentityManager(MemoryIdentityStorage(), MemoryPrivateKeyStorage()),
+                    NoVerifyPolicyManager())
+
+def make_certificate(keyChain, identity):
+    """Return (certificate name, wire encoding) of new self-signed certificate of the identity"""
+    import pyndn as ndn
+    certName = keyChain.createIdentityAndCertificate(ndn.Name(identity))
+    return certName, keyChain.getIdentityManager().getCertificate(certName).wireEncode().toBytes()
+
+_lastTimestamp = [0]
+
+def sign_command_interest(keyChain, certName, site_prefix, name, timestamp=None):
+    """
+    Return base64-encoded name of command interest <name>/<timestamp>/<site prefix>, as signed by
+    operators, with a new timestamp in milliseconds unless given
+    """
+    import base64
+    import time
+    import pyndn as ndn
+    if timestamp == None:
+        # a new timestamp for every interest, so that none is taken for a replay
+        _lastTimestamp[0] = timestamp = max(_lastTimestamp[0] + 1, int(time.time() * 1000))
+    interest = ndn.Interest(ndn.Name(name).append(str(timestamp)).append(ndn.Name(site_prefix).wireEncode()))
+    keyChain.sign(interest, certName)
+    return base64.b64encode(interest.getName().wireEncode().toBuffer()).decode('ascii')
+
+def load_script(argv):
+    """Load ndnop-process-requests as a module, as if run with the arguments"""
+    import importlib.machinery
+    savedArgv = sys.argv
+    sys.argv = ['ndnop-process-requests'] + argv
+    try:
+        loader = importlib.machinery.SourceFileLoader('ndnop_process_requests',
+                                                      os.path.join(BASEDIR, 'ndnop-process-requests'))
+        return loader.load_module()
+    finally:
+        sys.argv = savedArgv
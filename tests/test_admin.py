@@ -0,0 +1,33 @@
+import base64
+import hashlib
+
+import pytest
+
+@pytest.fixture
+def admin(server, db, monkeypatch):
+    monkeypatch.setitem(server.app.config, 'ADMIN_USERNAME', 'admin')
+    monkeypatch.setitem(server.app.config, 'ADMIN_PASSWORD', hashlib.sha256(b'secret').hexdigest())
+    client = server.app.test_client()
+    headers = {'Authorization': 'Basic ' + base64.b64encode(b'admin:secret').decode('ascii')}
+    return lambda url, data: client.post(url, data=data, headers=headers)
+
+def operator_form(site_prefix, site_name):
+    return {'site_prefix': site_prefix, 'site_name': site_name, 'site_emails': 'admin.edu',
+            'name': 'Operator', 'email': 'operator@admin.edu', 'key': ''}
+
+def test_duplicate_site_prefix_is_a_form_error(server, db, admin):
+    server.ensure_indexes()
+    assert admin('/admin/add-operator', operator_form('/ndn/edu/admin', 'First')).status_code == 302
+    assert admin('/admin/add-operator', operator_form('/ndn/edu/other', 'Other')).status_code == 302
+
+    r = admin('/admin/add-operator', operator_form('/ndn/edu/admin', 'Second'))
+    assert r.status_code == 200 and b'Another operator has the same site prefix' in r.data
+    assert db.operators.count_documents({}) == 2
+
+    other = db.operators.find_one({'site_prefix': '/ndn/edu/other'})
+    url = '/admin/edit-operator/%s' % other['_id']
+    r = admin(url, dict(operator_form('/ndn/edu/admin', 'Other')))
+    assert r.status_code == 200 and b'Another operator has the same site prefix' in r.data
+
+    assert admin(url, dict(operator_form('/ndn/edu/other', 'Renamed'))).status_code == 302
+    assert db.operators.find_one({'_id': other['_id']})['site_name'] == 'Renamed'
@@ -0,0 +1,69 @@
+import base64
+import datetime
+import json
+
+import pytest
+from bson.binary import Binary
+
+from conftest import make_certificate, sign_command_interest
+
+SITE_PREFIX = '/ndn/edu/candidates'
+
+@pytest.fixture
+def operator(server, db, keyChain):
+    certName, wire = make_certificate(keyChain, SITE_PREFIX)
+    operator = {'site_prefix': SITE_PREFIX, 'site_name': 'Candidates', 'site_emails': ['candidates.edu'],
+                'key': base64.b64encode(wire).decode('ascii')}
+    db.operators.insert_one(operator)
+    server.operators.invalidate()
+    operator['certName'] = certName
+    return operator
+
+def get_candidates(server, keyChain, operator, command='get', **params):
+    data = {'commandInterest': sign_command_interest(keyChain, operator['certName'], SITE_PREFIX,
+                                                     '/cert-requests/%s' % command),
+            'format': 'ndjson'}
+    data.update(params)
+    return server.app.test_client().post('/cert-requests/%s/' % command, data=data)
+
+def test_requests_of_older_versions_are_sent_as_wire(server, db, keyChain, operator):
+    certName, wire = make_certificate(keyChain, SITE_PREFIX + '/alice')
+    now = datetime.datetime.utcnow()
+    for cert_request in (Binary(wire), Binary(base64.b64encode(wire)), base64.b64encode(wire).decode('ascii')):
+        db.requests.insert_one({'operator_id': str(operator['_id']), 'site_prefix': '',
+                                'cert_request': cert_request, 'created_on': now})
+
+    r = get_candidates(server, keyChain, operator)
+    assert r.status_code == 200
+    requests = [json.loads(line) for line in r.data.splitlines()]
+    assert [base64.b64decode(req['cert_request']['$binary']) for req in requests] == [wire] * 3
+
+def test_wait_timeout_must_be_a_number(server, db, keyChain, operator):
+    for timeout in ('nan', 'inf', '-inf', 'soon'):
+        assert get_candidates(server, keyChain, operator, 'wait', timeout=timeout).status_code == 400
+    assert get_candidates(server, keyChain, operator, 'wait', timeout='0').status_code == 200
+
+def test_since_must_be_a_time(server, db, keyChain, operator):
+    for since in ('1e20', '-1e20', 'nan', 'yesterday'):
+        assert get_candidates(server, keyChain, operator, since=since).status_code == 400
+    assert get_candidates(server, keyChain, operator, since='0').status_code == 200
+
+def test_command_interest_is_only_valid_for_its_command(server, db, keyChain, operator):
+    client = server.app.test_client()
+    def post(route, command, **data):
+        data['commandInterest'] = sign_command_interest(keyChain, operator['certName'], SITE_PREFIX, command)
+        return client.post(route, data=data).status_code
+
+    assert post('/cert-requests/get/', '/cert-requests/get') == 200
+    assert post('/cert-requests/wait/', '/cert-requests/get', timeout='0') == 403
+    assert post('/cert-requests/get/', '/cert-requests/wait') == 403
+    assert post('/cert-requests/get/', '/cert-requests/get/extra') == 403
+    assert post('/cert/submit-batch/', '/cert-requests/get', decisions='[]') == 403
+    assert post('/cert/submit-batch/', '/cert/submit-batch', decisions='[]') == 403
+
+def test_failed_verification_is_counted(server, db, keyChain, operator):
+    otherCertName, wire = make_certificate(keyChain, '/ndn/edu/other')
+    unverified = server.replay_guard.unverified
+    data = {'commandInterest': sign_command_interest(keyChain, otherCertName, SITE_PREFIX, '/cert-requests/get')}
+    assert server.app.test_client().post('/cert-requests/get/', data=data).status_code == 403
+    assert server.replay_guard.unverified == unverified + 1
@@ -0,0 +1,24 @@
+import datetime
+
+def test_html_list_changes_with_operators(server, db):
+    now = datetime.datetime.utcnow()
+    operator_id = db.operators.insert_one({'site_prefix': '/ndn/edu/list', 'site_name': 'Old Name',
+                                           'site_emails': ['list.edu']}).inserted_id
+    server.operators.invalidate()
+    db.certs.insert_one({'name': '/ndn/edu/list/KEY/alice/ksk-1/ID-CERT/%FD%01',
+                         'operator_id': str(operator_id), 'site_prefix': '/ndn/edu/list',
+                         'site_name': 'Old Name', 'not_before': now - datetime.timedelta(days=1),
+                         'not_after': now + datetime.timedelta(days=1)})
+
+    client = server.app.test_client()
+    r = client.get('/cert/list/html')
+    assert r.status_code == 200 and b'Old Name' in r.data
+    etag = r.headers['ETag']
+    assert client.get('/cert/list/html', headers={'If-None-Match': etag}).status_code == 304
+
+    # renamed site, certificates are unchanged
+    db.operators.update_one({'_id': operator_id}, {'$set': {'site_name': 'New Name'}})
+    server.operators.invalidate()
+    r = client.get('/cert/list/html', headers={'If-None-Match': etag})
+    assert r.status_code == 200 and b'New Name' in r.data
+    assert r.headers['ETag'] != etag
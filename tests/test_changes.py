@@ -0,0 +1,70 @@
+import base64
+import datetime
+
+import pytest
+from bson.binary import Binary
+
+from www.changes import ADDED, REMOVED, ChangesExpired, record_cert_changes, get_cert_changes
+from www.generation import bump_generation
+
+def add_cert(db, name):
+    db.certs.insert_one({'name': name, 'cert': Binary(name.encode('ascii'))})
+    return record_cert_changes(db, added=[name])
+
+def test_changes_stop_at_recent_gap(server, db):
+    add_cert(db, '/a')
+    # sequence number taken by a change that is still being recorded
+    bump_generation(db, 'certs')
+    add_cert(db, '/c')
+
+    assert get_cert_changes(db, 0, 100, 60) == (1, {'/a': ADDED}, False)
+    assert get_cert_changes(db, 1, 100, 60) == (1, {}, False)
+
+def test_changes_pass_settled_gap(server, db):
+    add_cert(db, '/a')
+    bump_generation(db, 'certs')
+    add_cert(db, '/c')
+    db.cert_changes.update_many({}, {'$set': {'created_on': datetime.datetime.utcnow() -
+                                                            datetime.timedelta(seconds=120)}})
+
+    assert get_cert_changes(db, 0, 100, 60) == (3, {'/a': ADDED, '/c': ADDED}, False)
+
+def test_changes_are_paged_by_whole_changes(server, db):
+    add_cert(db, '/a')
+    record_cert_changes(db, added=['/b', '/c', '/d'])
+    add_cert(db, '/e')
+
+    assert get_cert_changes(db, 0, 2, 60) == (2, {'/a': ADDED, '/b': ADDED, '/c': ADDED, '/d': ADDED}, True)
+    assert get_cert_changes(db, 2, 2, 60) == (3, {'/e': ADDED}, False)
+    assert get_cert_changes(db, 3, 2, 60) == (3, {}, False)
+
+def test_expired_changes(server, db):
+    client = server.app.test_client()
+    assert client.get('/cert/changes?since=1').status_code == 410
+
+    add_cert(db, '/a')
+    add_cert(db, '/b')
+    assert client.get('/cert/changes?since=0').status_code == 200
+    # first change removed by CERT_CHANGES_TTL
+    db.cert_changes.delete_many({'seq': 1})
+    assert client.get('/cert/changes?since=0').status_code == 410
+    assert client.get('/cert/changes?since=1').json['version'] == 2
+    with pytest.raises(ChangesExpired):
+        get_cert_changes(db, 0, 100, 60)
+
+def test_added_then_deleted_cert_is_removed(server, db, monkeypatch):
+    client = server.app.test_client()
+    add_cert(db, '/a')
+    add_cert(db, '/b')
+    db.certs.delete_one({'name': '/a'})
+    record_cert_changes(db, removed=['/a'])
+
+    assert get_cert_changes(db, 0, 100, 60) == (3, {'/a': REMOVED, '/b': ADDED}, False)
+    r = client.get('/cert/changes?since=0').json
+    assert r == {'version': 3, 'more': False, 'removed': ['/a'],
+                 'added': [{'name': '/b', 'cert': base64.b64encode(b'/b').decode('ascii')}]}
+
+    # deleted after the returned version, but the certificate is gone already
+    monkeypatch.setitem(server.app.config, 'CERT_CHANGES_MAX', 1)
+    r = client.get('/cert/changes?since=0').json
+    assert r == {'version': 1, 'more': True, 'added': [], 'removed': ['/a']}
@@ -0,0 +1,88 @@
+import datetime
+
+import pytest
+
+DBNAME = 'ndncert_test_indexes'
+
+@pytest.fixture
+def mongod_db(server):
+    """Database of the app on a local mongod, with indexes created"""
+    import pymongo
+    client = pymongo.MongoClient('mongodb://localhost:27017', serverSelectionTimeoutMS=500)
+    try:
+        client.server_info()
+    except pymongo.errors.ServerSelectionTimeoutError:
+        pytest.skip("no mongod on localhost:27017")
+
+    saved = server.mongo.cx, server.mongo.db
+    server.mongo.cx, server.mongo.db = client, client[DBNAME]
+    try:
+        client.drop_database(DBNAME)
+        with server.app.app_context():
+            assert server.ensure_indexes() == []
+            yield server.mongo.db
+    finally:
+        client.drop_database(DBNAME)
+        server.mongo.cx, server.mongo.db = saved
+
+def stages(plan):
+    """Yield stage names of the query plan"""
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from stages(value)
+
+def winning_stages(cursor):
+    return list(stages(cursor.explain()['queryPlanner']['winningPlan']))
+
+def test_queries_use_indexes(mongod_db):
+    now = datetime.datetime.utcnow()
+    mongod_db.certs.insert_many([{'name': '/ndn/edu/site/user%d/KEY/ksk-1/ID-CERT/%%FD%%01' % i,
+                                  'not_before': now, 'not_after': now} for i in range(100)])
+    mongod_db.requests.insert_many([{'operator_id': str(i % 10), 'site_prefix': '', 'created_on': now}
+                                    for i in range(100)])
+    mongod_db.tokens.insert_many([{'token_hash': 'hash%d' % i, 'created_on': now} for i in range(100)])
+    mongod_db.cert_changes.insert_many([{'seq': i, 'name': 'name%d' % i, 'created_on': now}
+                                        for i in range(100)])
+
+    for cursor in [
+            mongod_db.certs.find({'name': '/ndn/edu/site/user1/KEY/ksk-1/ID-CERT/%FD%01'}),
+            # page of /cert/list/
+            mongod_db.certs.find({'name': {'$gt': '/ndn/edu/site/user5'}, 'not_after': {'$gt': now},
+                                  'not_before': {'$lte': now}}).sort([('name', 1)]).limit(11),
+            # /cert-requests/get/, all requests of the operator and only guest requests
+            mongod_db.requests.find({'operator_id': '1'}).sort([('created_on', 1)]),
+            mongod_db.requests.find({'operator_id': '1', 'created_on': {'$gt': now}}).sort([('created_on', 1)]),
+            mongod_db.requests.find({'operator_id': '1', 'site_prefix': '/ndn/edu/site'})
+                .sort([('created_on', 1)]),
+            mongod_db.tokens.find({'token_hash': 'hash1'}),
+            mongod_db.cert_changes.find({'seq': {'$gt': 90}}).sort([('seq', 1)]),
+            ]:
+        plan = winning_stages(cursor)
+        assert 'IXSCAN' in plan and 'COLLSCAN' not in plan and 'SORT' not in plan, plan
+
+def test_index_failures_do_not_stop_others(server, db):
+    db.certs.insert_many([{'name': '/ndn/edu/dup/KEY/alice/ID-CERT/%FD%01'} for i in range(2)])
+
+    failures = server.ensure_indexes()
+    assert [(collection, keys) for collection, keys, error in failures] == [('certs', 'name')]
+    assert 'token_hash_1' in db.tokens.index_information()
+    assert 'created_on_1' in db.cert_changes.index_information()
+
+def test_duplicate_certs_are_removed(server, db):
+    ids = db.certs.insert_many([{'name': '/ndn/edu/dup/KEY/%s/ID-CERT/%%FD%%01' % name}
+                                for name in ('alice', 'bob', 'alice', 'alice')]).inserted_ids
+    runner = server.app.test_cli_runner()
+
+    result = runner.invoke(args=['remove-duplicate-certs', '--dry-run'])
+    assert result.exit_code == 0 and db.certs.count_documents({}) == 4
+
+    result = runner.invoke(args=['remove-duplicate-certs'])
+    assert result.exit_code == 0
+    assert sorted(cert['_id'] for cert in db.certs.find()) == sorted([ids[1], ids[3]])
+    assert [change['name'] for change in db.cert_changes.find()] == ['/ndn/edu/dup/KEY/alice/ID-CERT/%FD%01']
+    assert server.ensure_indexes() == []
@@ -0,0 +1,153 @@
+import socket
+import socketserver
+import threading
+import time
+
+import pytest
+import pyndn as ndn
+
+from conftest import load_script
+
+@pytest.fixture(scope='module')
+def script():
+    return load_script(['--auto-approve', '/ndn/edu/publisher'])
+
+class StubRepo(socketserver.ThreadingTCPServer):
+    """TCP server keeping the bytes received on each connection"""
+    daemon_threads = True
+
+    def __init__(self):
+        self.received = []
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), StubRepoHandler)
+
+    def wait(self, connections, size, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if len(self.received) >= connections and sum(len(b) for b in self.received) >= size:
+                return self.received
+            time.sleep(0.01)
+        return self.received
+
+class StubRepoHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        received = bytearray()
+        self.server.received.append(received)
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                break
+            received += data
+
+@pytest.fixture
+def repo():
+    repo = StubRepo()
+    threading.Thread(target=repo.serve_forever, daemon=True).start()
+    yield repo
+    repo.shutdown()
+    repo.server_close()
+
+def test_packets_are_sent_over_one_connection(script, repo):
+    publisher = script.RepoPublisher(*repo.server_address)
+    assert publisher.publish(b'first', b'second')
+    assert publisher.publish(b'third')
+    publisher.close()
+
+    assert repo.wait(1, 16) == [b'firstsecondthird']
+    assert (publisher.packets, publisher.bytes, publisher.errors) == (3, 16, 0)
+    assert publisher.sendTime > 0
+
+def test_failed_connection_is_reopened(script, repo):
+    publisher = script.RepoPublisher(*repo.server_address)
+    assert publisher.publish(b'first')
+    # writes to the broken connection fail, the packet goes over a new one
+    publisher.sock.close()
+    assert publisher.publish(b'second')
+    publisher.close()
+
+    assert sorted(repo.wait(2, 11)) == [b'first', b'second']
+    assert (publisher.packets, publisher.bytes, publisher.errors) == (2, 11, 0)
+
+def test_unreachable_repo(script):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    publisher = script.RepoPublisher('127.0.0.1', port)
+    assert not publisher.publish(b'packet')
+    assert (publisher.packets, publisher.bytes, publisher.errors) == (0, 0, 1)
+    assert publisher.sock == None
+
+class FakeFace(object):
+    """Face answering one pending Interest per processEvents(), in the order they were expressed"""
+
+    def __init__(self, timeouts):
+        # number of first attempts of each update (by the name of the certificate) to time out
+        self.timeouts = timeouts
+        self.pending = []
+        self.attempts = {}
+        self.maxPending = 0
+        self.isShutdown = False
+
+    def expressInterest(self, name, onData, onTimeout):
+        self.pending.append((name, onData, onTimeout))
+        self.maxPending = max(self.maxPending, len(self.pending))
+
+    def processEvents(self):
+        if len(self.pending) == 0:
+            return
+        name, onData, onTimeout = self.pending.pop(0)
+        data = ndn.Data()
+        data.wireDecode(name[-2].getValue())
+        certName = data.getName().toUri()
+        self.attempts[certName] = self.attempts.get(certName, 0) + 1
+        if self.attempts[certName] <= self.timeouts.get(certName, 0):
+            onTimeout(ndn.Interest(name))
+        else:
+            onData(ndn.Interest(name), ndn.Data(name))
+
+    def shutdown(self):
+        self.isShutdown = True
+
+def publish_all(script, face, count, window, retries):
+    publisher = script.NdnsPublisher(ndn.Name('/ndn/edu/publisher'), window, retries, False)
+    publisher.face = face
+    for i in range(count):
+        publisher.publish(ndn.Data(ndn.Name('/ndn/edu/publisher/cert%d' % i)))
+        assert publisher.inFlight <= window
+    publisher.flush()
+    return publisher
+
+def test_updates_are_sent_within_window(script):
+    face = FakeFace({})
+    publisher = publish_all(script, face, 10, 3, 0)
+
+    assert face.maxPending == 3
+    assert len(face.attempts) == 10 and set(face.attempts.values()) == {1}
+    assert publisher.inFlight == 0
+    assert len(publisher.latencies) == 10 and publisher.failed == 0
+
+def test_timed_out_updates_are_retried(script):
+    # cert1 succeeds on the second attempt, cert2 times out on every attempt
+    face = FakeFace({'/ndn/edu/publisher/cert1': 1, '/ndn/edu/publisher/cert2': 10})
+    publisher = publish_all(script, face, 4, 2, 2)
+
+    assert face.attempts == {'/ndn/edu/publisher/cert0': 1, '/ndn/edu/publisher/cert1': 2,
+                             '/ndn/edu/publisher/cert2': 3, '/ndn/edu/publisher/cert3': 1}
+    # a retry takes the place of the timed out update in the window
+    assert face.maxPending == 2
+    assert publisher.inFlight == 0
+    assert len(publisher.latencies) == 3 and publisher.failed == 1
+
+def test_latency_includes_retries(script, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(script.time, 'time', lambda: clock[0])
+    monkeypatch.setattr(script.time, 'sleep', lambda seconds: clock.__setitem__(0, clock[0] + 1))
+
+    # a second passes after each processEvents(), the third attempt is answered in the third call
+    face = FakeFace({'/ndn/edu/publisher/cert0': 2})
+    publisher = publish_all(script, face, 1, 1, 2)
+    assert publisher.latencies == [2.0]
+
+    publisher.close()
+    assert face.isShutdown and publisher.face == None
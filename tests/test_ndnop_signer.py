@@ -0,0 +1,202 @@
+import base64
+import time
+
+import pytest
+import pyndn as ndn
+from pyndn.security import KeyChain
+from pyndn.security.certificate import IdentityCertificate
+
+from conftest import make_certificate, load_script
+from www.operator_verify_policy_manager import OperatorVerifyPolicyManager
+
+SITE_PREFIX = '/ndn/edu/signer'
+
+REQUEST = {'fullname': 'Alice Smith', 'organization': 'Signer University', 'email': 'alice@signer.edu',
+           'homeurl': 'http://signer.edu/~alice', 'group': 'Networking', 'advisor': 'Bob'}
+
+@pytest.fixture(scope='module')
+def script():
+    return load_script(['--in-process', '--auto-approve', SITE_PREFIX])
+
+@pytest.fixture(scope='module')
+def signer(script, keyChain):
+    signer = script.Signer(ndn.Name(SITE_PREFIX))
+    signer.keyChain = keyChain
+    signer.certName, signer.siteCert = make_certificate(keyChain, SITE_PREFIX)
+    return signer
+
+def make_request(keyChain, identity):
+    certName, wire = make_certificate(keyChain, identity)
+    request = dict(REQUEST)
+    request['cert_request'] = {'$binary': base64.b64encode(wire).decode('ascii')}
+    return request, keyChain.getIdentityManager().getCertificate(certName)
+
+def verify(signer, data):
+    verified = []
+    KeyChain(policyManager=OperatorVerifyPolicyManager({'key': base64.b64encode(signer.siteCert)})) \
+        .verifyData(data, lambda data: verified.append(True), lambda data: verified.append(False))
+    return verified == [True]
+
+def test_certificate(keyChain, signer):
+    request, certRequest = make_request(keyChain, SITE_PREFIX + '/alice')
+
+    cert = IdentityCertificate()
+    cert.wireDecode(ndn.Blob(base64.b64decode(signer.signCertificate(request))))
+
+    keyName = certRequest.getPublicKeyName()
+    name = cert.getName()
+    assert name[:-1] == ndn.Name(SITE_PREFIX).append('KEY').append(keyName[-2:]).append('ID-CERT')
+    assert name[-1].isVersion()
+    assert cert.getPublicKeyInfo().getKeyDer() == certRequest.getPublicKeyInfo().getKeyDer()
+
+    now = time.time() * 1000
+    assert abs(cert.getNotBefore() - (now - 86400 * 1000)) < 60000
+    assert abs(cert.getNotAfter() - (now + 365 * 86400 * 1000)) < 60000
+
+    descriptions = dict((str(d.getOid()), d.getValue().toRawStr()) for d in cert.getSubjectDescriptions())
+    assert descriptions == {'2.5.4.41': 'Alice Smith',
+                            '1.2.840.113549.1.9.1': 'alice@signer.edu',
+                            '2.5.4.11': 'Signer University',
+                            '2.5.4.1': 'Networking',
+                            '2.5.4.3': 'http://signer.edu/~alice',
+                            '2.5.4.80': 'Bob'}
+
+    assert verify(signer, cert)
+    cert.setContent(ndn.Blob(b'tampered'))
+    assert not verify(signer, cert)
+
+def test_revocation(keyChain, signer):
+    request, certRequest = make_request(keyChain, SITE_PREFIX + '/carol')
+
+    revocation = ndn.Data()
+    revocation.wireDecode(ndn.Blob(base64.b64decode(signer.signRevocation(request))))
+    assert revocation.getName()[:-1] == \
+        ndn.Name(SITE_PREFIX).append('KEY').append(certRequest.getPublicKeyName()[-2:]).append('ID-CERT')
+    assert revocation.getContent().size() == 0
+    assert verify(signer, revocation)
+
+def test_key_outside_of_site_is_not_signed(keyChain, signer):
+    request, certRequest = make_request(keyChain, '/ndn/edu/other/mallory')
+    with pytest.raises(RuntimeError):
+        signer.signCertificate(request)
+
+def test_jobs_cannot_be_used_in_process():
+    with pytest.raises(SystemExit):
+        load_script(['--in-process', '--jobs', '4', SITE_PREFIX])
+
+class StubResponse(object):
+    def __init__(self, lines=[], error=None, results=None, status_code=200):
+        self.status_code = status_code
+        self.lines = lines
+        self.error = error
+        self.results = results
+        self.text = ''
+
+    def json(self):
+        return self.results
+
+    def iter_lines(self):
+        for line in self.lines:
+            yield line
+        if self.error != None:
+            raise self.error
+
+class StubSession(object):
+    def __init__(self, response):
+        self.response = response
+
+    def post(self, url, data, stream=False):
+        return self.response
+
+def test_requests_are_read_before_processing(signer):
+    import requests
+    signer.session = StubSession(StubResponse([b'{"_id": 1}', b'', b'{"_id": 2}']))
+    assert signer.fetchRequests('interest') == [{'_id': 1}, {'_id': 2}]
+
+    signer.session = StubSession(StubResponse([b'{"_id": 1}'], requests.exceptions.ChunkedEncodingError()))
+    assert signer.fetchRequests('interest') == None
+
+    signer.session = StubSession(StubResponse([b'{"_id": 1}', b'{"_id": ']))
+    assert signer.fetchRequests('interest') == None
+
+def test_command_interest_timestamps_increase(signer):
+    names = []
+    for i in range(5):
+        name = ndn.Name()
+        name.wireDecode(ndn.Blob(base64.b64decode(signer.signCommandInterest(ndn.Name('/cert-requests/wait')))))
+        names.append(name)
+    timestamps = [int(name[-4].toEscapedString()) for name in names]
+    assert timestamps == sorted(set(timestamps))
+    assert abs(timestamps[0] / 1000.0 - time.time()) < 60
+
+def test_requests_seen_again_are_not_processed(keyChain, signer):
+    request, certRequest = make_request(keyChain, SITE_PREFIX + '/dave')
+    def req(id, created_on):
+        return dict(request, _id={'$oid': id}, created_on={'$date': created_on * 1000})
+
+    signer.count = 0
+    selected = signer.selectRequests([req('a', 100), req('b', 200)])
+    assert [req['_id']['$oid'] for req, certData in selected] == ['a', 'b']
+    assert signer.since == 200
+
+    # asked again with a margin, there is a request stored late, submitted before the newest one seen
+    selected = signer.selectRequests([req('a', 100), req('c', 150), req('b', 200)])
+    assert [req['_id']['$oid'] for req, certData in selected] == ['c']
+    assert signer.since == 200 and signer.count == 3
+
+def test_undecodable_request_is_skipped(keyChain, signer):
+    request, certRequest = make_request(keyChain, SITE_PREFIX + '/erin')
+    bad = dict(request, _id={'$oid': 'bad'}, created_on={'$date': 300000},
+               cert_request={'$binary': base64.b64encode(request['cert_request']['$binary'].encode('ascii'))
+                             .decode('ascii')})
+    good = dict(request, _id={'$oid': 'good'}, created_on={'$date': 300000})
+
+    selected = signer.selectRequests([bad, good])
+    assert [req['_id']['$oid'] for req, certData in selected] == ['good']
+
+def test_requests_not_accepted_are_tried_again(keyChain, signer):
+    request, certRequest = make_request(keyChain, SITE_PREFIX + '/frank')
+    def req(id, created_on):
+        return dict(request, _id={'$oid': id}, created_on={'$date': created_on * 1000})
+    signer.since = None
+    signer.seen = {}
+    signer.retry = {}
+
+    signer.count = 0
+    selected = list(signer.selectRequests([req('f1', 1000), req('f2', 2000), req('f3', 3000)]))
+    assert signer.watchSince() == 3000 - 60
+
+    signer.session = StubSession(StubResponse(results={'f1': 'issue', 'f2': 'database error', 'f3': 'issue'}))
+    signer.uploadDecisions([(req, b'', 'issue') for req, certData in selected])
+    assert signer.watchSince() == 2000 - 1
+
+    # tried again, even though it is older than the margin
+    signer.retry = {}
+    selected = signer.selectRequests([req('f1', 1000), req('f2', 2000), req('f3', 3000)])
+    assert [req['_id']['$oid'] for req, certData in selected] == ['f2']
+    assert signer.watchSince() == 3000 - 60
+
+    signer.session = StubSession(StubResponse(status_code=500))
+    signer.uploadDecisions([(req('f3', 3000), b'', 'issue')])
+    assert signer.retry == {'f3': 3000}
+
+def test_interactive_decisions_are_uploaded_right_away(keyChain, signer, script, monkeypatch):
+    request, certRequest = make_request(keyChain, SITE_PREFIX + '/grace')
+    requests = [dict(request, _id={'$oid': 'g%d' % i}, created_on={'$date': 4000000 + i}) for i in range(3)]
+    signer.seen = {}
+
+    uploaded = []
+    answers = []
+    def confirm(prompt, resp):
+        # each decision has been uploaded by the time the operator is asked for the next one
+        assert len(uploaded) == len(answers)
+        answers.append(len(answers) != 1)
+        return answers[-1]
+    monkeypatch.setattr(script.args, 'auto_approve', False)
+    monkeypatch.setattr(script, 'confirm', confirm)
+    monkeypatch.setattr(signer, 'publishCertificate', lambda cert: None)
+    monkeypatch.setattr(signer, 'uploadDecisions', lambda decisions: uploaded.append(decisions))
+
+    signer.processRequests(requests)
+    assert [[(req['_id']['$oid'], decision) for req, cert, decision in batch] for batch in uploaded] == \
+        [[('g0', 'issue')], [('g1', 'reject')], [('g2', 'issue')]]
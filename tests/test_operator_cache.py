@@ -0,0 +1,61 @@
+import pytest
+
+from www.operator_cache import DomainTrie
+
+def test_trie_exact_and_subdomains():
+    trie = DomainTrie()
+    trie.insert('ucla.edu', 'ucla', subdomains=True)
+    trie.insert('cs.ucla.edu', 'cs')
+    trie.insert('mit.edu', 'mit')
+
+    assert trie.lookup('ucla.edu') == 'ucla'
+    assert trie.lookup('UCLA.edu') == 'ucla'
+    assert trie.lookup('cs.ucla.edu') == 'cs'
+    assert trie.lookup('ee.ucla.edu') == 'ucla'
+    assert trie.lookup('mit.edu') == 'mit'
+    # subdomains are covered only if enabled for the domain
+    assert trie.lookup('csail.mit.edu') == None
+    assert trie.lookup('edu') == None
+    assert trie.lookup('example.com') == None
+    assert trie.lookup('ee.ucla.edu', exact=True) == None
+    assert trie.lookup('cs.ucla.edu', exact=True) == 'cs'
+
+def add_operator(db, server, site_prefix, domains, allowSubdomains=False):
+    db.operators.insert_one({'site_prefix': site_prefix, 'site_name': site_prefix, 'site_emails': domains,
+                             'allowSubdomains': allowSubdomains})
+    server.operators.invalidate()
+
+def test_subdomains_are_opt_in(server, db):
+    add_operator(db, server, '/ndn/edu/ucla', ['ucla.edu'])
+    with pytest.raises(Exception):
+        server.get_operator_for_email('tom@cs.ucla.edu')
+
+    add_operator(db, server, '/ndn/edu/mit', ['mit.edu'], allowSubdomains=True)
+    params = server.get_operator_for_email('tom@csail.mit.edu')
+    assert params['operator']['site_prefix'] == '/ndn/edu/mit'
+    assert params['assigned_namespace'].toUri() == '/ndn/edu/mit/csail/tom'
+
+def test_namespace_of_listed_subdomain_is_reserved(server, db):
+    add_operator(db, server, '/ndn/edu/ucla', ['ucla.edu', 'cs.ucla.edu'], allowSubdomains=True)
+    assert server.get_operator_for_email('tom@ucla.edu')['assigned_namespace'].toUri() == '/ndn/edu/ucla/tom'
+    # /ndn/edu/ucla/cs would be the prefix of /ndn/edu/ucla/cs/tom of tom@cs.ucla.edu
+    with pytest.raises(Exception):
+        server.get_operator_for_email('cs@ucla.edu')
+
+def test_namespace_used_by_covered_subdomain_is_refused(server, db):
+    add_operator(db, server, '/ndn/edu/ucla', ['ucla.edu'], allowSubdomains=True)
+    operator = db.operators.find_one({'site_prefix': '/ndn/edu/ucla'})
+    db.certs.insert_one({'name': '/ndn/edu/ucla/KEY/cs/ksk-1/ID-CERT/%FD%01'})
+    assert server.get_operator_for_email('cs@ucla.edu')['assigned_namespace'].toUri() == '/ndn/edu/ucla/cs'
+
+    # request of bob@ee.ucla.edu for /ndn/edu/ucla/ee/bob, under /ndn/edu/ucla/ee of ee@ucla.edu
+    db.requests.insert_one({'operator_id': str(operator['_id']), 'email': 'bob@EE.ucla.edu'})
+    with pytest.raises(Exception):
+        server.get_operator_for_email('ee@ucla.edu')
+    assert server.get_operator_for_email('e@ucla.edu')['assigned_namespace'].toUri() == '/ndn/edu/ucla/e'
+
+    # certificate of tom@cs.ucla.edu
+    db.certs.insert_one({'name': '/ndn/edu/ucla/KEY/cs/tom/ksk-2/ID-CERT/%FD%01'})
+    with pytest.raises(Exception):
+        server.get_operator_for_email('cs@ucla.edu')
+    assert server.get_operator_for_email('tom@ucla.edu')['assigned_namespace'].toUri() == '/ndn/edu/ucla/tom'
@@ -0,0 +1,98 @@
+import datetime
+import socket
+import types
+
+import pytest
+from flask import Flask
+from flask_mail import Mail, Message
+
+from www.outbox import Outbox
+
+mongomock = pytest.importorskip('mongomock')
+controller = pytest.importorskip('aiosmtpd.controller')
+
+class Sink(object):
+    """SMTP stand-in keeping received messages"""
+
+    def __init__(self):
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        return '250 OK'
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+@pytest.fixture
+def sink():
+    sink = Sink()
+    smtp = controller.Controller(sink, hostname='127.0.0.1', port=free_port())
+    smtp.start()
+    sink.port = smtp.port
+    yield sink
+    smtp.stop()
+
+def make_outbox(port):
+    app = Flask('outbox-test')
+    app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=port)
+    mongo = types.SimpleNamespace(db=mongomock.MongoClient().db)
+    return app, Outbox(mongo, Mail(app), max_attempts=3, retry_delay=60)
+
+def message(i):
+    return Message("Test %d" % i, sender='robot@example.net', recipients=['user%d@example.net' % i],
+                   body="body %d" % i, html="<p>body %d</p>" % i)
+
+def test_drain_sends_queued_messages(sink):
+    app, outbox = make_outbox(sink.port)
+    outbox.enqueue(message(0))
+    outbox.enqueue_many([message(1), message(2)])
+
+    with app.app_context():
+        assert outbox.drain(batch_size=2) == 2
+        assert outbox.drain() == 1
+        assert outbox.drain() == 0
+
+    assert sorted(m.rcpt_tos[0] for m in sink.messages) == ['user0@example.net', 'user1@example.net',
+                                                             'user2@example.net']
+    assert outbox.mongo.db.outbox.count_documents({}) == 0
+    sent, errors, seconds = outbox.totals()
+    assert (sent, errors) == (3, 0)
+    assert seconds > 0
+
+def test_failed_send_is_rescheduled():
+    app, outbox = make_outbox(free_port()) # nothing listens there
+    outbox.enqueue(message(0))
+
+    with app.app_context():
+        assert outbox.drain() == 0
+
+    item = outbox.mongo.db.outbox.find_one()
+    assert item['attempts'] == 1
+    assert item['next_attempt'] > datetime.datetime.utcnow() + datetime.timedelta(seconds=50)
+    assert item['last_error']
+    assert outbox.totals()[1] == 1
+
+    # not attempted again before the backoff delay
+    with app.app_context():
+        assert outbox.drain() == 0
+    assert outbox.mongo.db.outbox.find_one()['attempts'] == 1
+
+def test_sent_message_is_not_rescheduled_if_removal_fails(sink, monkeypatch):
+    app, outbox = make_outbox(sink.port)
+    outbox.enqueue(message(0))
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("database is down")
+    monkeypatch.setattr(mongomock.collection.Collection, 'remove', fail)
+
+    with app.app_context():
+        assert outbox.drain() == 1
+
+    assert len(sink.messages) == 1
+    # still claimed, so it is sent again only after claim_timeout
+    item = outbox.mongo.db.outbox.find_one()
+    assert item['attempts'] == 0
+    assert item['next_attempt'] > datetime.datetime.utcnow() + datetime.timedelta(seconds=outbox.claim_timeout - 10)
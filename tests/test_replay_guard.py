@@ -0,0 +1,31 @@
+import time
+
+from www.replay_guard import ReplayGuard
+
+SIGNER = '/ndn/edu/guard'
+
+def test_replays_and_older_timestamps_are_rejected():
+    guard = ReplayGuard(window=3600)
+    now = time.time()
+    assert guard.check(SIGNER, now, 'a') and guard.record(SIGNER, now, 'a')
+    assert not guard.check(SIGNER, now, 'a')
+    assert not guard.check(SIGNER, now - 1, 'b')
+    assert not guard.check(SIGNER, now - 7200, 'c')
+    assert guard.check('/ndn/edu/other', now - 1, 'b')
+
+def test_precise_timestamps_have_own_window():
+    guard = ReplayGuard(window=15 * 3600, precise_window=300)
+    now = time.time()
+    assert guard.check(SIGNER, now - 3600, 'a')
+    assert not guard.check(SIGNER, now - 3600, 'a', precise=True)
+    assert guard.check(SIGNER, now - 60, 'a', precise=True)
+
+def test_legacy_timestamp_ahead_does_not_block_precise_ones():
+    # local time stamped as UTC by an older script west of Greenwich
+    guard = ReplayGuard(window=15 * 3600, precise_window=300)
+    now = time.time()
+    assert guard.record(SIGNER, now + 8 * 3600, 'legacy')
+    assert guard.check(SIGNER, now, 'precise', precise=True)
+    assert guard.record(SIGNER, now, 'precise', precise=True)
+    assert not guard.check(SIGNER, now - 1, 'older', precise=True)
+    assert not guard.check(SIGNER, now, 'legacy again')
@@ -0,0 +1,123 @@
+import base64
+import datetime
+import hashlib
+import json
+import time
+
+import pytest
+
+from conftest import make_certificate, sign_command_interest
+
+SITE_PREFIX = '/ndn/edu/batch'
+
+@pytest.fixture
+def operator(server, db, keyChain):
+    certName, wire = make_certificate(keyChain, SITE_PREFIX)
+    operator = {'site_prefix': SITE_PREFIX, 'site_name': 'Batch', 'site_emails': ['batch.edu'],
+                'key': base64.b64encode(wire).decode('ascii')}
+    db.operators.insert_one(operator)
+    server.operators.invalidate()
+    db.certs.create_index('name', unique=True)
+    operator['certName'] = certName
+    return operator
+
+def add_request(db, operator, email):
+    return db.requests.insert_one({'operator_id': str(operator['_id']), 'site_prefix': '', 'email': email,
+                                   'fullname': 'User', 'organization': 'Batch',
+                                   'created_on': datetime.datetime.utcnow()}).inserted_id
+
+def submit(server, keyChain, operator, encodedDecisions):
+    name = '/cert/submit-batch/%s' % hashlib.sha256(encodedDecisions.encode('utf-8')).hexdigest()
+    return server.app.test_client().post('/cert/submit-batch/', data={
+        'commandInterest': sign_command_interest(keyChain, operator['certName'], SITE_PREFIX, name),
+        'decisions': encodedDecisions})
+
+def test_malformed_decisions_are_rejected(server, keyChain, operator):
+    assert submit(server, keyChain, operator, '[{"id": ').status_code == 400
+    assert submit(server, keyChain, operator, '{"id": "x", "data": ""}').status_code == 400
+    assert submit(server, keyChain, operator, '[{"data": "AAAA"}]').status_code == 400
+    assert submit(server, keyChain, operator, '[{"id": 1, "data": "AAAA"}]').status_code == 400
+
+def test_invalid_and_unknown_decisions(server, db, keyChain, operator):
+    certName, wire = make_certificate(keyChain, SITE_PREFIX + '/alice')
+    r = submit(server, keyChain, operator, json.dumps([
+        {'id': 'not an id', 'data': base64.b64encode(wire).decode('ascii')},
+        {'id': '0123456789abcdef01234567', 'data': base64.b64encode(wire).decode('ascii')},
+        {'id': 'fedcba9876543210fedcba98', 'data': 'not a packet'},
+        ]))
+    assert r.status_code == 200
+    assert r.get_json() == {'not an id': 'invalid decision',
+                            '0123456789abcdef01234567': 'unknown request',
+                            'fedcba9876543210fedcba98': 'invalid decision'}
+
+def test_duplicate_certificate_does_not_affect_other_decisions(server, db, keyChain, operator):
+    dupName, dupWire = make_certificate(keyChain, SITE_PREFIX + '/bob')
+    newName, newWire = make_certificate(keyChain, SITE_PREFIX + '/carol')
+    db.certs.insert_one({'name': dupName.toUri(), 'cert': dupWire})
+
+    dupRequest = add_request(db, operator, 'bob@batch.edu')
+    newRequest = add_request(db, operator, 'carol@batch.edu')
+    rejectedRequest = add_request(db, operator, 'dave@batch.edu')
+    import pyndn as ndn
+    revocation = ndn.Data(ndn.Name(SITE_PREFIX + '/KEY/dave/ID-CERT'))
+    keyChain.sign(revocation, operator['certName'])
+
+    r = submit(server, keyChain, operator, json.dumps([
+        {'id': str(dupRequest), 'data': base64.b64encode(dupWire).decode('ascii')},
+        {'id': str(newRequest), 'data': base64.b64encode(newWire).decode('ascii')},
+        {'id': str(rejectedRequest),
+         'data': base64.b64encode(revocation.wireEncode().toBytes()).decode('ascii')},
+        ]))
+    assert r.status_code == 200
+    assert r.get_json() == {str(dupRequest): 'certificate not stored: already exists',
+                            str(newRequest): 'issue',
+                            str(rejectedRequest): 'reject'}
+
+    # the request of the certificate that has not been stored stays pending, without notification
+    assert [req['_id'] for req in db.requests.find()] == [dupRequest]
+    assert db.certs.count_documents({}) == 2
+    assert [change['name'] for change in db.cert_changes.find()] == [newName.toUri()]
+    assert sorted(item['recipients'][0] for item in db.outbox.find()) == ['carol@batch.edu', 'dave@batch.edu']
+
+def test_timestamps_in_seconds_are_accepted(server, db, keyChain):
+    # as sent by older versions of ndnop-process-requests
+    site_prefix = SITE_PREFIX + '/seconds'
+    certName, wire = make_certificate(keyChain, site_prefix)
+    db.operators.insert_one({'site_prefix': site_prefix, 'site_name': 'Seconds', 'site_emails': [],
+                             'key': base64.b64encode(wire).decode('ascii')})
+    server.operators.invalidate()
+
+    client = server.app.test_client()
+    def get(timestamp):
+        return client.post('/cert-requests/get/', data={
+            'commandInterest': sign_command_interest(keyChain, certName, site_prefix, '/cert-requests/get',
+                                                     timestamp),
+            'format': 'ndjson'}).status_code
+
+    now = int(time.time())
+    assert get(now) == 200
+    assert get(now) == 403 # replay
+    assert get(now * 1000 + 1) == 200
+    assert get(now - 1) == 403 # older
+    assert get(now - 86400 * 30) == 403 # stale
+
+def test_legacy_timestamp_does_not_block_upgraded_script(server, db, keyChain):
+    # older scripts stamp local time as UTC, e.g., 8 hours ahead in PST
+    site_prefix = SITE_PREFIX + '/upgraded'
+    certName, wire = make_certificate(keyChain, site_prefix)
+    db.operators.insert_one({'site_prefix': site_prefix, 'site_name': 'Upgraded', 'site_emails': [],
+                             'key': base64.b64encode(wire).decode('ascii')})
+    server.operators.invalidate()
+
+    client = server.app.test_client()
+    def get(timestamp=None):
+        return client.post('/cert-requests/get/', data={
+            'commandInterest': sign_command_interest(keyChain, certName, site_prefix, '/cert-requests/get',
+                                                     timestamp),
+            'format': 'ndjson'}).status_code
+
+    assert get(int(time.time()) + 8 * 3600) == 200
+    assert get() == 200
+    assert get() == 200
+    # milliseconds only have a few minutes of tolerance
+    assert get(int((time.time() - 3600) * 1000)) == 403
@@ -1,12 +1,15 @@
-from flask import Blueprint, render_template, abort, request, redirect, url_for, Response, current_app
+from flask import Blueprint, render_template, abort, request, redirect, url_for, Response, current_app, jsonify
 from jinja2 import TemplateNotFound
 from functools import wraps
 import hashlib
 from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
 
 admin = Blueprint('admin', __name__, template_folder='templates')
 
 from . import auth
+from . import cache
+from . import metrics
 
 from wtforms import Form, BooleanField, TextField, SubmitField, HiddenField, TextAreaField, validators
 from wtforms.validators import *
@@ -16,6 +19,9 @@ class RegistrationForm(Form):
     site_prefix = TextField('Site Prefix', [Required()])
     site_name   = TextField('Site Name', [Required()])
     site_emails = TextField('Site Emails', [Required()])
+    allowSubdomains = BooleanField('Site emails also cover their subdomains (list subdomains that have '
+                                   'their own users, to keep their namespaces from other users)',
+                                   false_values=[False])
     name        = TextField('Operator Name', [Required()])
     email       = TextField('Operator Email', [Required()])
     allowGuests = BooleanField('Allow guest accounts', false_values=[False])
@@ -23,6 +29,8 @@ class RegistrationForm(Form):
     doNotSendOpRequests          = BooleanField('Disable all security operator requests', false_values=[False])
     key         = TextAreaField('Operator public key certificate (base64)')
 
+SITE_PREFIX_EXISTS = 'Another operator has the same site prefix'
+
 class Operator(dict):
     def getlist(self, key):
         if key == 'site_emails':
@@ -47,8 +55,13 @@ def add_operator():
     if request.method == 'POST' and form.validate():
         operator = form.data
         operator['site_emails'] = [s.strip() for s in operator['site_emails'].split(";")]
-        current_app.mongo.db.operators.insert(operator)
-        return redirect(url_for('admin.list_operators'))
+        try:
+            current_app.mongo.db.operators.insert(operator)
+        except DuplicateKeyError:
+            form.site_prefix.errors.append(SITE_PREFIX_EXISTS)
+        else:
+            current_app.operators.invalidate()
+            return redirect(url_for('admin.list_operators'))
     return render_template('admin/add-or-edit.html', form=form,
                            title="Add operator")
 
@@ -66,11 +79,15 @@ def edit_operator(id):
 
         operator = form.data
         operator['site_emails'] = [s.strip() for s in operator['site_emails'].split(";")]
-        current_app.mongo.db.operators.update({'_id': ObjectId(id)},
-                                              {'$set': operator},
-                                              upsert=False, multi=False)
-
-        return redirect(url_for('admin.list_operators'))
+        try:
+            current_app.mongo.db.operators.update({'_id': ObjectId(id)},
+                                                  {'$set': operator},
+                                                  upsert=False, multi=False)
+        except DuplicateKeyError:
+            form.site_prefix.errors.append(SITE_PREFIX_EXISTS)
+        else:
+            current_app.operators.invalidate()
+            return redirect(url_for('admin.list_operators'))
 
     return render_template('admin/add-or-edit.html', form=form,
                            title="Edit operator")
@@ -79,4 +96,50 @@ def edit_operator(id):
 @auth.requires_auth
 def delete_operator(id):
     current_app.mongo.db.operators.remove({'_id': ObjectId(id)})
+    current_app.operators.invalidate()
     return redirect(url_for('admin.list_operators'))
+
+@admin.route('/admin/stats', methods = ['GET'], strict_slashes=False)
+@auth.requires_auth
+def show_stats():
+    return jsonify(caches=dict((name, c.stats()) for name, c in cache.caches.items()),
+                   operator_cache_loads=current_app.operators.loads,
+                   replay_guard=current_app.replay_guard.stats(),
+                   outbox=current_app.outbox.stats(),
+                   rate_limited=current_app.rate_limiter.rejected)
+
+@admin.route('/metrics', methods = ['GET'])
+@auth.requires_auth
+def show_metrics():
+    """Metrics of this server process (and queue and totals of mail workers) for Prometheus"""
+    caches = cache.caches.values()
+    outbox = current_app.outbox.stats()
+    sent, errors, sendSeconds = current_app.outbox.totals()
+    collected = [
+        metrics.Collected('gauge', 'ndncert_cache_size', 'Entries in in-process cache', ('cache',),
+                          lambda: [((c.name,), c.stats()['size']) for c in caches]),
+        metrics.Collected('counter', 'ndncert_cache_hits_total', 'In-process cache hits', ('cache',),
+                          lambda: [((c.name,), c.hits) for c in caches]),
+        metrics.Collected('counter', 'ndncert_cache_misses_total', 'In-process cache misses', ('cache',),
+                          lambda: [((c.name,), c.misses) for c in caches]),
+        metrics.Collected('counter', 'ndncert_cache_evictions_total', 'In-process cache evictions', ('cache',),
+                          lambda: [((c.name,), c.evictions) for c in caches]),
+        metrics.Collected('counter', 'ndncert_operator_cache_loads_total', 'Loads of the operators collection', (),
+                          lambda: [((), current_app.operators.loads)]),
+        metrics.Collected('counter', 'ndncert_command_interests_total', 'Operator command interests', ('result',),
+                          lambda: [(('accepted',), current_app.replay_guard.accepted),
+                                   (('rejected',), current_app.replay_guard.rejected),
+                                   (('unverified',), current_app.replay_guard.unverified)]),
+        metrics.Collected('counter', 'ndncert_rate_limited_total', 'Requests rejected by rate limits', (),
+                          lambda: [((), current_app.rate_limiter.rejected)]),
+        metrics.Collected('gauge', 'ndncert_outbox_messages', 'Queued email messages', ('state',),
+                          lambda: [(('pending',), outbox['pending']), (('failed',), outbox['failed'])]),
+        metrics.Collected('counter', 'ndncert_smtp_sent_total', 'Email messages sent by all mail workers', (),
+                          lambda: [((), sent)]),
+        metrics.Collected('counter', 'ndncert_smtp_errors_total', 'SMTP errors of all mail workers', (),
+                          lambda: [((), errors)]),
+        metrics.Collected('counter', 'ndncert_smtp_send_seconds_total',
+                          'Time all mail workers spent sending messages', (),
+                          lambda: [((), sendSeconds)]),
+        ]
+    return Response(metrics.render(metrics.registry + collected), mimetype='text/plain; version=0.0.4')
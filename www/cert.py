@@ -1,7 +1,9 @@
-from flask import Blueprint, render_template, abort, request, redirect, url_for, Response, current_app, make_response
+from flask import Blueprint, render_template, abort, request, redirect, url_for, Response, current_app, make_response, \
+                  stream_with_context
 from jinja2 import TemplateNotFound
 from functools import wraps
 import hashlib
+import json
 from bson.objectid import ObjectId
 import base64
 
@@ -12,12 +14,107 @@ from datetime import datetime
 cert = Blueprint('cert', __name__, template_folder='templates')
 
 from . import auth
+from .cache import LRUCache
+from .metrics import timed, ndn_seconds
+from .generation import get_generation
+from .changes import ADDED, ChangesExpired, record_cert_changes, get_cert_changes
+
+# decoded certificates keyed by name and content hash, so that deleted or reissued
+# certificates are never served from stale entries
+decoded_certs = LRUCache('decoded_certs', 1024)
+
+@cert.record_once
+def configure(state):
+    decoded_certs.maxsize = state.app.config.get('CERT_CACHE_SIZE', decoded_certs.maxsize)
+
+def get_wire(cert):
+    """Return wire encoding of the certificate record content"""
+    if isinstance(cert['cert'], str):
+        # base64 string stored by older versions, see `flask migrate-binary-certs`
+        return base64.b64decode(cert['cert'])
+    return bytes(cert['cert'])
+
+@timed(ndn_seconds, 'decode_certificate')
+def decode_certificate(wire):
+    """Decode wire-encoded certificate into IdentityCertificate"""
+    d = ndn.security.certificate.IdentityCertificate()
+    d.wireDecode(bytearray(wire))
+    return d
+
+def get_validity(d):
+    """Return (notBefore, notAfter) of the decoded certificate as UTC datetimes"""
+    notBefore = datetime.utcfromtimestamp(d.getNotBefore() / 1000)
+    notAfter = datetime.utcfromtimestamp(d.getNotAfter() / 1000)
+    return notBefore, notAfter
+
+def get_digest(cert):
+    """Return hex SHA-256 digest of the certificate record content"""
+    return hashlib.sha256(get_wire(cert)).hexdigest()
+
+def get_decoded_certificate(cert):
+    """Return (IdentityCertificate, notBefore, notAfter) for the certificate record"""
+    key = (cert['name'], get_digest(cert))
+    decoded = decoded_certs.get(key)
+    if decoded == None:
+        d = decode_certificate(get_wire(cert))
+        decoded = (d,) + get_validity(d)
+        decoded_certs.put(key, decoded)
+    return decoded
+
+def is_not_modified(etag, last_modified):
+    """Check conditional request headers against the current validators"""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if last_modified != None and request.if_modified_since != None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+def make_cacheable(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified != None:
+        response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config.get('CERT_CACHE_MAX_AGE', 60)
+    return response
+
+def not_modified(etag, last_modified):
+    return make_cacheable(Response(status=304), etag, last_modified)
+
+def get_page_args():
+    """Return (after, limit) keyset pagination arguments of the request"""
+    after = request.args.get('after')
+    try:
+        limit = int(request.args.get('limit', current_app.config.get('CERT_LIST_PAGE_SIZE', 500)))
+    except ValueError:
+        abort(400)
+    limit = max(1, min(limit, current_app.config.get('CERT_LIST_MAX_PAGE_SIZE', 5000)))
+    return after, limit
+
+def get_page(query, projection, after, limit):
+    """Return one page of certificates ordered by name and the name to continue after"""
+    if after:
+        query = dict(query, name={'$gt': after})
+    certs = list(current_app.mongo.db.certs.find(query, projection).sort([('name', 1)]).limit(limit + 1))
+    if len(certs) > limit:
+        return certs[:limit], certs[limit - 1]['name']
+    return certs, None
+
+def add_site_info(certs):
+    """Update site name and prefix stored with the certificates from the current operators"""
+    for cert in certs:
+        operator = current_app.operators.find_by_id(cert.get('operator_id'))
+        if operator != None:
+            cert['site_name'] = operator['site_name']
+            cert['site_prefix'] = operator['site_prefix']
 
 # Public interface
 @cert.route('/cert/get/', methods = ['GET'])
 def get_certificate():
     name = request.args.get('name')
     isView = request.args.get('view')
+    # certificates are downloaded base64-encoded, as expected by ndnsec-install-cert,
+    # unless encoding=binary is requested
+    isBinary = request.args.get('encoding') == 'binary'
 
     ndn_name = ndn.Name(str(name))
 
@@ -26,64 +123,143 @@ def get_certificate():
         abort(404)
 
     if not isView:
-        response = make_response(cert['cert'])
+        etag = '%s%s' % ('binary-' if isBinary else '', get_digest(cert))
+        if is_not_modified(etag, cert['created_on']):
+            return not_modified(etag, cert['created_on'])
+
+        wire = get_wire(cert)
+        response = make_response(wire if isBinary else base64.b64encode(wire))
         response.headers['Content-Type'] = 'application/octet-stream'
         response.headers['Content-Disposition'] = 'attachment; filename=%s.ndncert' % str(ndn_name[-3])
-        return response
+        return make_cacheable(response, etag, cert['created_on'])
     else:
-        d = ndn.security.certificate.IdentityCertificate()
-        d.wireDecode(bytearray(base64.b64decode(cert['cert'])))
-
-        notBefore = datetime.utcfromtimestamp(d.getNotBefore() / 1000)
-        notAfter = datetime.utcfromtimestamp(d.getNotAfter() / 1000)
+        d, notBefore, notAfter = get_decoded_certificate(cert)
         cert['from'] = notBefore
         cert['to'] = notAfter
-        now = datetime.now()
+        now = datetime.utcnow()
         cert['isValid'] = (notBefore <= now and now <= notAfter)
         cert['info'] = d
+        cert['base64'] = base64.b64encode(get_wire(cert)).decode('ascii')
 
-        return render_template('cert-show.html',
-                               cert=cert, title=cert['name'])
+        # the rendered page also depends on whether the certificate is still valid
+        etag = 'view-%s-%d' % (get_digest(cert), cert['isValid'])
+        if is_not_modified(etag, cert['created_on']):
+            return not_modified(etag, cert['created_on'])
+
+        return make_cacheable(make_response(render_template('cert-show.html',
+                                                            cert=cert, title=cert['name'])),
+                              etag, cert['created_on'])
 
 
 # Public interface
 @cert.route('/cert/list/', methods = ['GET'])
 def get_certificates():
-    certificates = current_app.mongo.db.certs.find().sort([('name', 1)])
-    return make_response(render_template('cert-list.txt', certificates=certificates), 200, {
-            'Content-Type': 'text/plain'
-            })
+    generation, updated_on = get_generation(current_app.mongo.db, 'certs')
+    etag = 'certs-%d' % generation
+    if is_not_modified(etag, updated_on):
+        return not_modified(etag, updated_on)
+
+    # stream the list, so memory use does not depend on the number of certificates
+    certificates = current_app.mongo.db.certs.find({}, {'name': 1, '_id': 0}).sort([('name', 1)])
+    template = current_app.jinja_env.get_template('cert-list.txt')
+    return make_cacheable(Response(stream_with_context(template.generate(certificates=certificates)),
+                                   mimetype='text/plain'), etag, updated_on)
+
+# Public interface for mirrors: bootstrap from /cert/snapshot, then poll /cert/changes
+# with the returned version; added certificates are base64-encoded, as by /cert/get/
+@cert.route('/cert/snapshot', methods = ['GET'])
+def get_snapshot():
+    # the version is read first: certificates changed while the snapshot is streamed are
+    # also returned by /cert/changes, and applying a change twice has no effect
+    generation, updated_on = get_generation(current_app.mongo.db, 'certs')
+    etag = 'certs-snapshot-%d' % generation
+    if is_not_modified(etag, updated_on):
+        return not_modified(etag, updated_on)
+
+    certificates = current_app.mongo.db.certs.find({}, {'name': 1, 'cert': 1, '_id': 0}).sort([('name', 1)])
+    def generate():
+        separator = '{"version": %d, "removed": [], "added": [' % generation
+        for cert in certificates:
+            yield separator + json.dumps(encode_cert(cert))
+            separator = ','
+        yield ']}' if separator == ',' else separator + ']}'
+    return make_cacheable(Response(stream_with_context(generate()), mimetype='application/json'),
+                          etag, updated_on)
+
+@cert.route('/cert/changes', methods = ['GET'])
+def get_changes():
+    try:
+        since = int(request.args['since'])
+    except (KeyError, ValueError):
+        abort(400)
+
+    try:
+        version, latest, more = get_cert_changes(current_app.mongo.db, since,
+                                                 current_app.config.get('CERT_CHANGES_MAX', 5000),
+                                                 current_app.config.get('CERT_CHANGES_SETTLE_TIME', 60))
+    except ChangesExpired:
+        # the mirror has to start over from /cert/snapshot
+        abort(410)
+
+    addedNames = [name for name, action in latest.items() if action == ADDED]
+    added = [encode_cert(cert) for cert in
+             current_app.mongo.db.certs.find({'name': {'$in': addedNames}}, {'name': 1, 'cert': 1, '_id': 0})]
+    # certificates deleted after the returned version are reported as removed rather than
+    # sent: their removal also comes with a later version, and removing twice has no effect
+    found = set(cert['name'] for cert in added)
+    removed = [name for name, action in latest.items() if action != ADDED or name not in found]
+
+    return Response(json.dumps({'version': version, 'more': more, 'added': added, 'removed': removed}),
+                    mimetype='application/json')
+
+def encode_cert(cert):
+    return {'name': cert['name'], 'cert': base64.b64encode(get_wire(cert)).decode('ascii')}
 
 @cert.route('/cert/list/html', methods = ['GET'])
 def list_certs_html():
-    certs = current_app.mongo.db.certs.find({ '$query': {},
-                                         '$orderby': { 'name' : 1, 'operator.site_prefix': 1 }})
-    certsWithInfo = []
-    for cert in certs:
-        info = cert
-        d = ndn.security.certificate.IdentityCertificate()
-        d.wireDecode(bytearray(base64.b64decode(cert['cert'])))
+    # validity period is decoded once on insert (see `flask backfill-cert-validity` for
+    # older records), so expired certificates are filtered out by the database
+    now = datetime.utcnow()
+
+    # besides changes of the collection, the list changes as certificates expire; the
+    # hourly validator bounds how long an expired certificate can stay listed.  Site
+    # names and prefixes are taken from the operators, so their changes count too
+    generation, updated_on = get_generation(current_app.mongo.db, 'certs')
+    operators_generation, operators_updated_on = get_generation(current_app.mongo.db, 'operators')
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    etag = 'certs-html-%d-%d-%s' % (generation, operators_generation, hour.strftime('%Y%m%d%H'))
+    last_modified = max(t for t in (updated_on, operators_updated_on, hour) if t != None)
+    if is_not_modified(etag, last_modified):
+        return not_modified(etag, last_modified)
 
-        notBefore = datetime.utcfromtimestamp(d.getNotBefore() / 1000)
-        notAfter = datetime.utcfromtimestamp(d.getNotAfter() / 1000)
-        now = datetime.now()
-        if notBefore <= now and now <= notAfter:
-            info['to'] = notAfter.strftime('%Y-%m-%d')
-            certsWithInfo.append(info)
+    after, limit = get_page_args()
+    certs, next_after = get_page({'not_before': {'$lte': now}, 'not_after': {'$gte': now}},
+                                 {'name': 1, 'not_after': 1, 'operator_id': 1, 'site_name': 1, 'site_prefix': 1},
+                                 after, limit)
+    add_site_info(certs)
+    for cert in certs:
+        cert['to'] = cert['not_after'].strftime('%Y-%m-%d')
 
-    return render_template('cert-list.html',
-                           certs=certsWithInfo, title="List of issued and not expired certificates")
+    return make_cacheable(make_response(render_template('cert-list.html', certs=certs,
+                                                        next_after=next_after, limit=limit,
+                                                        title="List of issued and not expired certificates")),
+                          etag, last_modified)
 
 @cert.route('/cert/list/admin', methods = ['GET'])
 @auth.requires_auth
 def list_certs_admin():
-    certs = current_app.mongo.db.certs.find({ '$query': {},
-                                         '$orderby': { 'name' : 1, 'operator.site_prefix': 1 }})
+    after, limit = get_page_args()
+    certs, next_after = get_page({}, {'name': 1, 'operator_id': 1, 'site_name': 1, 'site_prefix': 1},
+                                 after, limit)
+    add_site_info(certs)
     return render_template('admin/cert-list.html',
-                           certs=certs, title="List of issued certificates")
+                           certs=certs, next_after=next_after, limit=limit,
+                           title="List of issued certificates")
 
 @cert.route('/admin/delete-cert/<id>', methods = ['GET', 'POST'])
 @auth.requires_auth
 def delete_cert(id):
-    current_app.mongo.db.certs.remove({'_id': ObjectId(id)})
+    deleted = current_app.mongo.db.certs.find_one_and_delete({'_id': ObjectId(id)}, {'name': 1})
+    if deleted != None:
+        record_cert_changes(current_app.mongo.db, removed=[deleted['name']])
     return redirect(url_for('cert.list_certs_admin'))
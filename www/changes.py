@@ -0,0 +1,61 @@
+import datetime
+
+from .generation import get_generation, bump_generation
+
+# Every change of the certs collection is numbered by the `certs` generation and
+# recorded in the `cert_changes` collection, one document per added or removed
+# certificate name, so that mirrors can apply only what changed since their last sync.
+
+ADDED = 'add'
+REMOVED = 'remove'
+
+def record_cert_changes(db, added=[], removed=[]):
+    """Record names of added and removed certificates as one change, return its sequence number"""
+    seq = bump_generation(db, 'certs')
+    now = datetime.datetime.utcnow()
+    changes = [{'seq': seq, 'name': name, 'action': ADDED, 'created_on': now} for name in added] + \
+              [{'seq': seq, 'name': name, 'action': REMOVED, 'created_on': now} for name in removed]
+    if len(changes) > 0:
+        db.cert_changes.insert_many(changes)
+    return seq
+
+class ChangesExpired(Exception):
+    pass
+
+def get_cert_changes(db, since, limit, settle_time):
+    """
+    Return (version, {name: action}, more) with the latest action for each certificate
+    changed after sequence number `since`.
+
+    Sequence numbers are taken before the change is recorded, so a missing number
+    may belong to a change that is still being recorded; changes are returned only up
+    to such a gap, unless it is older than settle_time seconds.  Whole changes are
+    returned until there are more than `limit` names, `more` tells whether to ask again.
+
+    Raises ChangesExpired if changes after `since` are no longer available (removed by
+    CERT_CHANGES_TTL, or never recorded), and the mirror has to start over from a snapshot.
+    """
+    generation, updated_on = get_generation(db, 'certs')
+    if since > generation:
+        raise ChangesExpired()
+    if since == generation:
+        return since, {}, False
+
+    oldest = db.cert_changes.find_one({}, {'seq': 1}, sort=[('seq', 1)])
+    if oldest == None or oldest['seq'] > since + 1:
+        raise ChangesExpired()
+
+    settled = datetime.datetime.utcnow() - datetime.timedelta(seconds=settle_time)
+    version = since
+    latest = {}
+    more = False
+    for change in db.cert_changes.find({'seq': {'$gt': since}}).sort([('seq', 1)]):
+        if change['seq'] != version:
+            if change['seq'] > version + 1 and change['created_on'] > settled:
+                break
+            if len(latest) >= limit:
+                more = True
+                break
+            version = change['seq']
+        latest[change['name']] = change['action']
+    return version, latest, more
@@ -0,0 +1,21 @@
+import datetime
+from pymongo import ReturnDocument
+
+# Generation counters are kept in the `generations` collection, one document per
+# tracked collection, and are bumped on every change of that collection.  They give
+# cheap validators for cached responses and are shared between all server workers.
+
+def get_generation(db, name):
+    """Return (generation, updated_on) of the named collection"""
+    doc = db.generations.find_one({'_id': name})
+    if doc == None:
+        return 0, None
+    return doc['generation'], doc['updated_on']
+
+def bump_generation(db, name):
+    """Record a change of the named collection and return its new generation"""
+    doc = db.generations.find_one_and_update({'_id': name},
+                                             {'$inc': {'generation': 1},
+                                              '$set': {'updated_on': datetime.datetime.utcnow()}},
+                                             upsert=True, return_document=ReturnDocument.AFTER)
+    return doc['generation']
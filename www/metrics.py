@@ -0,0 +1,184 @@
+from contextlib import contextmanager
+from functools import wraps
+import threading
+import time
+
+from flask import request, g
+from pymongo import monitoring
+
+# Metrics of the server process, reported by /metrics in Prometheus text format.
+# Only the few metric types used here are implemented, to avoid another dependency.
+
+# all metrics created in the process, in the order of creation
+registry = []
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + 1
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in sorted(self._values.items())]
+
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {} # labels -> [count per bucket..., count, sum]
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            values = self._values.get(labels)
+            if values == None:
+                values = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+                    break
+            values[-2] += 1
+            values[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, *labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((labels, list(values)) for labels, values in self._values.items())
+        samples = []
+        for labels, values in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                samples.append((self.name + '_bucket', labels + (repr(bound),), cumulative))
+            samples.append((self.name + '_bucket', labels + ('+Inf',), values[-2]))
+            samples.append((self.name + '_count', labels, values[-2]))
+            samples.append((self.name + '_sum', labels, values[-1]))
+        return samples
+
+class Collected(object):
+    """Gauge or counter read from `collect`, a function returning [(labels, value), ...], when reported"""
+
+    def __init__(self, type, name, help, labelnames, collect):
+        self.type = type
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.collect = collect
+
+    def samples(self):
+        return [(self.name, tuple(labels), value) for labels, value in self.collect()]
+
+def timed(histogram, *labels):
+    """Decorator recording the duration of each call of the function"""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            with histogram.time(*labels):
+                return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+def render(metrics):
+    """Format metrics in Prometheus text exposition format"""
+    lines = []
+    for metric in metrics:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.type))
+        for name, labels, value in metric.samples():
+            names = metric.labelnames + (('le',) if name.endswith('_bucket') else ())
+            if names:
+                name += '{%s}' % ','.join('%s="%s"' % (n, escape(v)) for n, v in zip(names, labels))
+            lines.append('%s %s' % (name, float(value) if isinstance(value, float) else value))
+    return '\n'.join(lines) + '\n'
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+#############################################################################################
+# Metrics of the web server
+#############################################################################################
+
+request_seconds = Histogram('ndncert_http_request_duration_seconds',
+                            'Time to produce the response (streamed bodies excluded)', ('route', 'method'))
+requests_total = Counter('ndncert_http_requests_total', 'HTTP requests', ('route', 'method', 'status'))
+
+mongo_seconds = Histogram('ndncert_mongo_command_duration_seconds', 'MongoDB command latency',
+                          ('collection', 'command'))
+mongo_failures = Counter('ndncert_mongo_command_failures_total', 'Failed MongoDB commands',
+                         ('collection', 'command'))
+
+ndn_seconds = Histogram('ndncert_ndn_duration_seconds', 'Time spent decoding and verifying NDN packets',
+                        ('operation',))
+
+def init_app(app):
+    """Time all requests of the app"""
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.time()
+
+    @app.after_request
+    def record_request(response):
+        started = getattr(g, 'metrics_started', None)
+        if started != None:
+            # routes rather than URLs, so that the number of label values stays bounded
+            route = request.url_rule.rule if request.url_rule != None else 'unmatched'
+            request_seconds.observe(time.time() - started, route, request.method)
+            requests_total.inc(route, request.method, str(response.status_code))
+        return response
+
+class MongoCommandListener(monitoring.CommandListener):
+    """
+    Records latency of MongoDB commands per collection.
+
+    Must be registered with pymongo.monitoring.register() before the client is created.
+    """
+
+    def __init__(self):
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        # the collection is only known from the command document of the started event
+        collection = event.command.get(event.command_name)
+        if event.command_name == 'getMore':
+            collection = event.command.get('collection')
+        if not isinstance(collection, str):
+            collection = ''
+        with self._lock:
+            self._collections[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event):
+        mongo_seconds.observe(event.duration_micros / 1e6, self._pop(event), event.command_name)
+
+    def failed(self, event):
+        collection = self._pop(event)
+        mongo_seconds.observe(event.duration_micros / 1e6, collection, event.command_name)
+        mongo_failures.inc(collection, event.command_name)
+
+    def _pop(self, event):
+        with self._lock:
+            return self._collections.pop((event.connection_id, event.request_id), '')
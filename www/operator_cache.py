@@ -0,0 +1,115 @@
+import threading
+import time
+
+from .generation import get_generation, bump_generation
+
+class DomainTrie(object):
+    """
+    Maps domain names to values, resolving the domain itself or the longest registered
+    suffix that has been inserted with subdomains=True.
+
+    Labels are stored in reverse order (edu -> ucla -> cs), so a lookup is a single
+    walk whose cost depends only on the number of labels in the looked up domain.
+    """
+
+    def __init__(self):
+        self._root = {}
+
+    def insert(self, domain, value, subdomains=False):
+        node = self._root
+        for label in reversed(domain.lower().split('.')):
+            node = node.setdefault(label, {})
+        # the None key holds (value, subdomains) registered for the domain ending at this node
+        node.setdefault(None, (value, subdomains))
+
+    def lookup(self, domain, exact=False):
+        labels = list(reversed(domain.lower().split('.')))
+        node = self._root
+        found = None
+        for i, label in enumerate(labels):
+            node = node.get(label)
+            if node == None:
+                break
+            value, subdomains = node.get(None, (None, False))
+            if i == len(labels) - 1:
+                return value if value != None or exact else found
+            if subdomains and not exact:
+                found = value
+        return found
+
+class OperatorCache(object):
+    """
+    In-memory copy of the operators collection.
+
+    The collection is tiny and only changes through the admin interface, which
+    calls invalidate().  Other server processes notice the change through the
+    `operators` generation counter, checked at most once per check_interval seconds.
+    """
+
+    def __init__(self, mongo, check_interval=5):
+        self.mongo = mongo
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._generation = None
+        self._checked_on = 0
+        self._maps = (DomainTrie(), {}, {}, [], None)
+        self.loads = 0
+
+    def invalidate(self):
+        """Notify all server processes that the operators collection has been changed"""
+        bump_generation(self.mongo.db, 'operators')
+        with self._lock:
+            self._generation = None
+
+    def find_by_domain(self, domain, exact=False):
+        """
+        Return operator for the domain listed in site_emails, or (unless exact) for the
+        closest parent domain of an operator that covers subdomains
+        """
+        return self._get_maps()[0].lookup(domain, exact)
+
+    def find_guest(self):
+        """Return operator handling users of unknown domains (`guest` in site_emails)"""
+        return self._get_maps()[4]
+
+    def find_by_site_prefix(self, site_prefix):
+        return self._get_maps()[1].get(site_prefix)
+
+    def find_by_id(self, id):
+        return self._get_maps()[2].get(str(id))
+
+    def guest_sites(self):
+        """Return operators that allow guest accounts, ordered by site prefix"""
+        return self._get_maps()[3]
+
+    def _get_maps(self):
+        with self._lock:
+            now = time.time()
+            if self._generation != None and now - self._checked_on < self.check_interval:
+                return self._maps
+
+            generation, updated_on = get_generation(self.mongo.db, 'operators')
+            self._checked_on = now
+            if generation != self._generation:
+                self._maps = self._load()
+                self._generation = generation
+            return self._maps
+
+    def _load(self):
+        byDomain = DomainTrie()
+        bySitePrefix = {}
+        byId = {}
+        guestSites = []
+        guest = None
+        for operator in self.mongo.db.operators.find().sort([('site_prefix', 1)]):
+            for domain in operator.get('site_emails', []):
+                if domain == 'guest':
+                    guest = guest or operator
+                else:
+                    byDomain.insert(domain, operator, operator.get('allowSubdomains', False))
+            bySitePrefix[operator['site_prefix']] = operator
+            byId[str(operator['_id'])] = operator
+            if operator.get('allowGuests'):
+                guestSites.append(operator)
+        self.loads += 1
+        return byDomain, bySitePrefix, byId, guestSites, guest
@@ -0,0 +1,114 @@
+import datetime
+import time
+
+from flask_mail import Message
+from pymongo import ReturnDocument
+
+class Outbox(object):
+    """
+    Persistent queue of outgoing email messages (`outbox` collection).
+
+    Request handlers only enqueue messages; `flask mail-worker` drains the queue over
+    a single SMTP connection.  Messages that could not be sent are retried with
+    exponential backoff until max_attempts is reached, after which they stay in the
+    collection for inspection.
+
+    Delivery is at least once: a message that has been sent, but not removed from the
+    queue (the worker died, or the database failed), is sent again after claim_timeout.
+    """
+
+    def __init__(self, mongo, mail, max_attempts=8, retry_delay=60, claim_timeout=300):
+        self.mongo = mongo
+        self.mail = mail
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.claim_timeout = claim_timeout
+        self.sent = 0
+        self.errors = 0
+        self.sendTime = 0.0
+
+    def enqueue(self, msg):
+        self.mongo.db.outbox.insert(self._make_item(msg))
+
+    def enqueue_many(self, msgs):
+        self.mongo.db.outbox.insert_many([self._make_item(msg) for msg in msgs])
+
+    def drain(self, batch_size=100):
+        """Send up to batch_size queued messages over one SMTP connection, return number sent"""
+        item = self._claim()
+        if item == None:
+            return 0
+
+        sent = 0
+        errors = self.errors
+        sendTime = self.sendTime
+        try:
+            with self.mail.connect() as connection:
+                while item != None:
+                    started = time.time()
+                    connection.send(Message(item['subject'], sender=item['sender'],
+                                            recipients=item['recipients'],
+                                            body=item['body'], html=item['html']))
+                    self.sendTime += time.time() - started
+                    self.sent += 1
+                    sent += 1
+
+                    # the message must not be rescheduled as unsent if the removal fails
+                    sentItem, item = item, None
+                    self.mongo.db.outbox.remove({'_id': sentItem['_id']})
+                    item = self._claim() if sent < batch_size else None
+        except Exception as e:
+            # the connection may be unusable now, leave the rest of the queue for the next run
+            self.errors += 1
+            if item != None:
+                self._reschedule(item, e)
+
+        # totals of all mail workers, for /metrics of the web server
+        self.mongo.db.outbox_stats.update({'_id': 'smtp'},
+                                          {'$inc': {'sent': sent, 'errors': self.errors - errors,
+                                                    'send_seconds': self.sendTime - sendTime}},
+                                          upsert=True)
+        return sent
+
+    def stats(self):
+        return {
+            'pending': self.mongo.db.outbox.find({'attempts': {'$lt': self.max_attempts}}).count(),
+            'failed': self.mongo.db.outbox.find({'attempts': {'$gte': self.max_attempts}}).count(),
+            'sent': self.sent,
+            'errors': self.errors,
+            'avg_send_latency': self.sendTime / self.sent if self.sent else 0.0,
+            }
+
+    def totals(self):
+        """Return (sent, errors, seconds spent sending) of all mail workers"""
+        doc = self.mongo.db.outbox_stats.find_one({'_id': 'smtp'}) or {}
+        return doc.get('sent', 0), doc.get('errors', 0), doc.get('send_seconds', 0.0)
+
+    def _make_item(self, msg):
+        now = datetime.datetime.utcnow()
+        return {
+            'subject': msg.subject,
+            'sender': msg.sender,
+            'recipients': msg.recipients,
+            'body': msg.body,
+            'html': msg.html,
+            'attempts': 0,
+            'next_attempt': now,
+            'created_on': now,
+            }
+
+    def _claim(self):
+        # postpone the message while it is being sent, so that it is retried if the worker dies
+        now = datetime.datetime.utcnow()
+        return self.mongo.db.outbox.find_one_and_update(
+            {'next_attempt': {'$lte': now}, 'attempts': {'$lt': self.max_attempts}},
+            {'$set': {'next_attempt': now + datetime.timedelta(seconds=self.claim_timeout)}},
+            sort=[('next_attempt', 1)], return_document=ReturnDocument.AFTER)
+
+    def _reschedule(self, item, error):
+        delay = self.retry_delay * 2 ** item['attempts']
+        self.mongo.db.outbox.update({'_id': item['_id']},
+                                    {'$inc': {'attempts': 1},
+                                     '$set': {'next_attempt': datetime.datetime.utcnow() +
+                                                              datetime.timedelta(seconds=delay),
+                                              'last_error': str(error)}})
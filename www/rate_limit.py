@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from functools import wraps
+import datetime
+import threading
+import time
+
+from flask import request, current_app, abort
+from pymongo import ReturnDocument
+
+class RateLimiter(object):
+    """
+    Per-key rate limits, configured as {name: (requests per second, burst)}.
+
+    By default each server process keeps a token bucket per (limit name, key) in
+    memory, dropping the least recently used buckets beyond maxsize.  If `mongo` is
+    given, all processes share counters in the `rate_limits` collection instead,
+    allowing `burst` requests per `burst / rate` seconds window.
+    """
+
+    def __init__(self, limits, mongo=None, maxsize=100000):
+        self.limits = limits
+        self.mongo = mongo
+        self.maxsize = maxsize
+        self._buckets = OrderedDict() # (name, key) -> (tokens, updated)
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def allow(self, name, key):
+        limit = self.limits.get(name)
+        if limit == None or not key:
+            return True
+        rate, burst = limit
+
+        if self.mongo != None:
+            allowed = self._allow_shared(name, key, rate, burst)
+        else:
+            now = time.time()
+            with self._lock:
+                tokens, updated = self._buckets.pop((name, key), (burst, now))
+                tokens = min(burst, tokens + (now - updated) * rate)
+                allowed = tokens >= 1
+                if allowed:
+                    tokens -= 1
+                self._buckets[(name, key)] = (tokens, now)
+                if len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+
+        if not allowed:
+            self.rejected += 1
+        return allowed
+
+    def _allow_shared(self, name, key, rate, burst):
+        window = burst / rate
+        start = int(time.time() // window)
+        counter = self.mongo.db.rate_limits.find_one_and_update(
+            {'_id': '%s:%s:%d' % (name, key, start)},
+            {'$inc': {'count': 1},
+             '$setOnInsert': {'expires_on': datetime.datetime.utcfromtimestamp((start + 1) * window)}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+        return counter['count'] <= burst
+
+def client_address():
+    return request.remote_addr
+
+def form_email():
+    return request.form.get('email', '').strip().lower()
+
+def rate_limited(*limits, **kwargs):
+    """
+    Reject requests exceeding any of the limits with 429, before the route does any work.
+
+    Each limit is (name in RATE_LIMITS, function returning the key of the request);
+    limits apply only to the listed methods (all methods by default).
+    """
+    methods = kwargs.get('methods')
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if methods == None or request.method in methods:
+                for name, key in limits:
+                    if not current_app.rate_limiter.allow(name, key()):
+                        abort(429)
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
@@ -0,0 +1,94 @@
+from collections import OrderedDict
+import datetime
+import threading
+import time
+
+from pymongo.errors import DuplicateKeyError
+
+class ReplayGuard(object):
+    """
+    Rejects stale and replayed command interests before they are verified.
+
+    For each signer (site prefix) the timestamp of the last verified interest is kept;
+    older interests, as well as interests whose timestamp is further than `window`
+    seconds from the current time, are stale.  Exact replays within the window are
+    detected by the digest of the interest signature, remembered for `window` seconds
+    in a bounded in-memory set and, if `mongo` is given, in the `command_interests`
+    collection (with TTL index, see ensure_indexes) shared by all server processes.
+
+    Precise (millisecond) timestamps are checked against `precise_window` and against
+    the last precise timestamp of the signer only: second timestamps of older clients
+    can be off by the time zone offset of the operator, and must not make correct
+    timestamps look stale.
+
+    check() is cheap and does not change any state, so it can run before signature
+    verification; record() must only be called for verified interests, and failed()
+    for interests that passed check() but not verification.
+    """
+
+    def __init__(self, window, maxsize=100000, mongo=None, precise_window=None):
+        self.window = window
+        self.precise_window = precise_window if precise_window != None else window
+        self.maxsize = maxsize
+        self.mongo = mongo
+        self._lock = threading.Lock()
+        self._lastTimestamps = {}
+        self._seen = OrderedDict() # digest -> expiration time, in the order of expiration
+        self.accepted = 0
+        self.rejected = 0
+        self.unverified = 0
+
+    def check(self, signer, timestamp, digest, precise=False):
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if abs(now - timestamp) > (self.precise_window if precise else self.window) or \
+               timestamp < self._lastTimestamps.get((signer, precise), 0) or \
+               digest in self._seen:
+                self.rejected += 1
+                return False
+            return True
+
+    def record(self, signer, timestamp, digest, precise=False):
+        now = time.time()
+        with self._lock:
+            if digest in self._seen:
+                self.rejected += 1
+                return False
+            self._seen[digest] = now + self.window
+            if len(self._seen) > self.maxsize:
+                self._seen.popitem(last=False)
+            key = (signer, precise)
+            self._lastTimestamps[key] = max(timestamp, self._lastTimestamps.get(key, 0))
+
+        if self.mongo != None:
+            try:
+                self.mongo.db.command_interests.insert({'_id': digest, 'created_on': datetime.datetime.utcnow()})
+            except DuplicateKeyError:
+                # already seen by another server process
+                with self._lock:
+                    self.rejected += 1
+                return False
+
+        with self._lock:
+            self.accepted += 1
+        return True
+
+    def failed(self):
+        with self._lock:
+            self.unverified += 1
+
+    def stats(self):
+        return {
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'unverified': self.unverified,
+            'seen': len(self._seen),
+            }
+
+    def _expire(self, now):
+        while self._seen:
+            digest, expires = next(iter(self._seen.items()))
+            if expires > now:
+                break
+            self._seen.popitem(last=False)
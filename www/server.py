@@ -19,7 +19,7 @@
 # pip install Flask, Flask-PyMongo
 
 #html/rest
-from flask import Flask, jsonify, abort, make_response, request, render_template
+from flask import Flask, jsonify, abort, make_response, request, render_template, Response, stream_with_context
 from flask_pymongo import PyMongo
 from flask_mail import Mail, Message
 
@@ -28,36 +28,72 @@ import smtplib
 from email.mime.text import MIMEText
 import smtplib
 import os
-import string
-import random
+import secrets
 import datetime
 import base64
+import hashlib
 
 import json
+import math
+import re
 import urllib.parse
+import time
+import click
 
 from bson import json_util
 from bson.objectid import ObjectId
+from bson.binary import Binary
+from pymongo.errors import OperationFailure, BulkWriteError, PyMongoError
+from pymongo import monitoring
 
 import pyndn as ndn
 from pyndn.security import KeyChain
 from .operator_verify_policy_manager import OperatorVerifyPolicyManager
+from .operator_cache import OperatorCache
+from .cache import LRUCache
+from .replay_guard import ReplayGuard
+from .outbox import Outbox
+from .rate_limit import RateLimiter, rate_limited, client_address, form_email
+from . import metrics
 
 tmpl_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
 
 # name of app is also name of mongodb "database"
 app = Flask("ndncert", template_folder=tmpl_dir)
 app.config.from_pyfile('%s/settings.py' % os.path.dirname(os.path.abspath(__file__)))
+# settings of the deployment (or of the benchmark, see bench/run.py) override the defaults
+app.config.from_envvar('NDNCERT_SETTINGS', silent=True)
+# command listeners only apply to clients created after registration
+monitoring.register(metrics.MongoCommandListener())
 mongo = PyMongo(app)
 mail = Mail(app)
+operators = OperatorCache(mongo, app.config.get('OPERATOR_CACHE_CHECK_INTERVAL', 5))
+
+replay_guard = ReplayGuard(app.config.get('COMMAND_INTEREST_WINDOW', 15 * 3600),
+                           app.config.get('COMMAND_INTEREST_MAX_SEEN', 100000),
+                           mongo if app.config.get('COMMAND_INTEREST_SHARED_REPLAY_CHECK') else None,
+                           app.config.get('COMMAND_INTEREST_PRECISE_WINDOW', 300))
+
+outbox = Outbox(mongo, mail,
+                app.config.get('MAIL_MAX_ATTEMPTS', 8),
+                app.config.get('MAIL_RETRY_DELAY', 60))
+
+rate_limiter = RateLimiter(app.config.get('RATE_LIMITS', {}),
+                           mongo if app.config.get('RATE_LIMIT_SHARED') else None)
 
 app.mongo = mongo
 app.mail = mail
+app.rate_limiter = rate_limiter
+app.outbox = outbox
+app.operators = operators
+app.replay_guard = replay_guard
 
 from .admin import admin
-from .cert import cert
+from .cert import cert, get_wire, decode_certificate, get_validity
+from .changes import record_cert_changes
 app.register_blueprint(admin)
 app.register_blueprint(cert)
+metrics.init_app(app)
 
 #############################################################################################
 # User-facing components
@@ -65,13 +101,14 @@ app.register_blueprint(cert)
 
 @app.route('/', methods = ['GET'])
 @app.route('/tokens/request/', methods = ['GET', 'POST'])
+@rate_limited(('token-address', client_address), ('token-email', form_email), methods = ['POST'])
 def request_token():
     if request.method == 'GET':
         #################################################
         ###              Token request                ###
         #################################################
 
-        guestSites = mongo.db.operators.find({'allowGuests':True})
+        guestSites = operators.guest_sites()
         return render_template('token-request-form.html', URL=app.config['URL'], sites=guestSites)
 
     else: # 'POST'
@@ -82,7 +119,6 @@ def request_token():
         user_email = request.form['email']
         site_prefix = request.form['site']
         if site_prefix != "":
-            params = get_operator_for_guest_site(user_email, site_prefix)
             try:
                 params = get_operator_for_guest_site(user_email, site_prefix)
             except:
@@ -94,23 +130,27 @@ def request_token():
             except:
                 return render_template('error-unknown-site.html')
 
-        token = {
+        user_token = generate_token()
+        # only the hash of the token is stored, the token itself is known to the user only
+        mongo.db.tokens.insert({
             'email': user_email,
-            'token': generate_token(),
+            'token_hash': hash_token(user_token),
             'site_prefix': site_prefix,
             'created_on': datetime.datetime.utcnow(), # to periodically remove unverified tokens
-            }
-        mongo.db.tokens.insert(token)
+            })
 
         if params['domain'] == 'operators.named-data.net':
-            return render_template('token-email.html', URL=app.config['URL'], **token)
+            return render_template('token-email.html', URL=app.config['URL'],
+                                   email=user_email, token=user_token)
         else:
             msg = Message("[NDN Certification] Request confirmation",
                           sender = app.config['MAIL_FROM'],
                           recipients = [user_email],
-                          body = render_template('token-email.txt', URL=app.config['URL'], **token),
-                          html = render_template('token-email.html', URL=app.config['URL'], **token))
-            mail.send(msg)
+                          body = render_template('token-email.txt', URL=app.config['URL'],
+                                                 email=user_email, token=user_token),
+                          html = render_template('token-email.html', URL=app.config['URL'],
+                                                 email=user_email, token=user_token))
+            outbox.enqueue(msg)
             return render_template('token-sent.html', email=user_email)
 
 @app.route('/help', methods = ['GET'])
@@ -118,13 +158,14 @@ def show_help():
     return render_template('how-it-works.html')
 
 @app.route('/cert-requests/submit/', methods = ['GET', 'POST'])
+@rate_limited(('submit-address', client_address))
 def submit_request():
     if request.method == 'GET':
         # Email and token (to authorize the request==validate email)
         user_email = request.args.get('email')
         user_token = request.args.get('token')
 
-        token = mongo.db.tokens.find_one({'email':user_email, 'token':user_token})
+        token = find_token(user_email, user_token)
         if (token == None):
             abort(403)
 
@@ -151,7 +192,7 @@ def submit_request():
         user_email = request.form['email']
         user_token = request.form['token']
 
-        token = mongo.db.tokens.find_one({'email':user_email, 'token':user_token})
+        token = find_token(user_email, user_token)
         if (token == None):
             abort(403)
 
@@ -218,7 +259,7 @@ def submit_request():
                 'homeurl': user_homeurl,
                 'group': user_group,
                 'advisor': user_advisor,
-                'cert_request': base64.b64encode(user_cert_request),
+                'cert_request': Binary(user_cert_request),
                 'created_on': datetime.datetime.utcnow(), # to periodically remove unverified tokens
             }
         mongo.db.requests.insert(cert_request)
@@ -237,7 +278,7 @@ def submit_request():
                           html = render_template('operator-notify-email.html', URL=app.config['URL'],
                                                  operator_name=params['operator']['name'],
                                                  **cert_request))
-            mail.send(msg)
+            outbox.enqueue(msg)
 
         return render_template('request-thankyou.html')
 
@@ -247,56 +288,46 @@ def submit_request():
 
 @app.route('/cert-requests/get/', methods = ['POST'])
 def get_candidates():
-    commandInterestName = ndn.Name()
-    commandInterestName.wireDecode(
-        # ndn.Blob(buffer(base64.b64decode(request.form['commandInterest']))))
-        ndn.Blob(base64.b64decode(request.form['commandInterest'])))
+    commandInterestName, operator = verify_command_interest(request.form['commandInterest'], '/cert-requests/get')
 
-    site_prefix = ndn.Name()
-    site_prefix.wireDecode(commandInterestName[-3].getValue().toBuffer())
-    timestamp  = commandInterestName[-4]
-
-    signature = ndn.WireFormat.getDefaultWireFormat().decodeSignatureInfoAndValue(commandInterestName[-2].getValue().toBuffer(),
-                                                                                  commandInterestName[-1].getValue().toBuffer())
-    keyLocator = signature.getKeyLocator().getKeyName()
+    # Will get here if verification succeeds
+    query, projection, limit = get_candidates_query(operator)
+    return stream_candidates(mongo.db.requests.find(query, projection).sort([('created_on', 1)]).limit(limit))
 
-    operator = mongo.db.operators.find_one({'site_prefix': site_prefix.toUri()})
-    if operator == None:
-        abort(403)
+@app.route('/cert-requests/wait/', methods = ['POST'])
+def wait_for_candidates():
+    """Same as /cert-requests/get/, but waits up to `timeout` seconds for a matching request to arrive"""
+    commandInterestName, operator = verify_command_interest(request.form['commandInterest'], '/cert-requests/wait')
 
+    query, projection, limit = get_candidates_query(operator)
     try:
-        keyChain = KeyChain(policyManager = OperatorVerifyPolicyManager(operator))
-
-        def onVerified(interest):
-            pass
-
-        def onVerifyFailed(interest):
-            raise RuntimeError("Operator verification failed")
-
-        keyChain.verifyInterest(ndn.Interest(commandInterestName), onVerified, onVerifyFailed, stepCount=1)
-    except Exception as e:
-        print("ERROR: %s" % e)
-        abort(403)
-
-    # Will get here if verification succeeds
-    requests = mongo.db.requests.find({'operator_id': str(operator['_id'])})
-    output = []
-    for req in requests:
-        output.append(req)
-
-    return json.dumps(output, default=json_util.default)
+        timeout = float(request.form.get('timeout', 0))
+    except ValueError:
+        abort(400)
+    if not math.isfinite(timeout):
+        abort(400)
+    timeout = min(timeout, app.config.get('CANDIDATES_WAIT_MAX_TIMEOUT', 60))
+
+    # the check is a lookup in an index of requests (see ensure_indexes)
+    deadline = time.time() + timeout
+    while mongo.db.requests.find_one(query, {'_id': 1}) == None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(remaining, app.config.get('CANDIDATES_WAIT_POLL_INTERVAL', 1)))
+
+    return stream_candidates(mongo.db.requests.find(query, projection).sort([('created_on', 1)]).limit(limit))
 
 @app.route('/cert/submit/', methods = ['POST'])
 def submit_certificate():
-    data = ndn.Data()
-    # data.wireDecode(ndn.Blob(buffer(base64.b64decode(request.form['data']))))
-    data.wireDecode(ndn.Blob(memoryview(base64.b64decode(request.form['data']))))
+    wire = base64.b64decode(request.form['data'])
+    data = decode_data(wire)
 
     cert_request = mongo.db.requests.find_one({'_id': ObjectId(str(request.form['id']))})
     if cert_request == None:
         abort(403)
 
-    operator = mongo.db.operators.find_one({"_id": ObjectId(cert_request['operator_id'])})
+    operator = operators.find_by_id(cert_request['operator_id'])
     if operator == None:
         mongo.db.requests.remove(cert_request) # remove invalid request
         abort(403)
@@ -304,57 +335,281 @@ def submit_certificate():
     # # @todo verify data packet
     # # @todo verify timestamp
 
-    if len(data.getContent()) == 0:
-        # (no deny reason for now)
-        # eventually, need to check data.type: if NACK, then content contains reason for denial
-        #                                      if KEY, then content is the certificate
-
-        msg = Message("[NDN Certification] Rejected certification",
-                      sender = app.config['MAIL_FROM'],
-                      recipients = [cert_request['email']],
-                      body = render_template('cert-rejected-email.txt',
-                                             URL=app.config['URL'], **cert_request),
-                      html = render_template('cert-rejected-email.html',
-                                             URL=app.config['URL'], **cert_request))
-        mail.send(msg)
+    cert, msg = make_decision(cert_request, operator, data, wire)
+    if cert != None:
+        mongo.db.certs.insert(cert)
+        record_cert_changes(mongo.db, added=[cert['name']])
+    outbox.enqueue(msg)
 
-        mongo.db.requests.remove(cert_request)
+    mongo.db.requests.remove(cert_request)
 
+    if cert == None:
         return "OK. Certificate has been denied"
     else:
-        cert = {
-            'name': data.getName().toUri(),
-            'cert': request.form['data'],
-            'operator': operator,
-            'created_on': datetime.datetime.utcnow(), # to periodically remove unverified tokens
-            }
-        mongo.db.certs.insert(cert)
+        return "OK. Certificate has been approved and notification sent to the requester"
 
-        msg = Message("[NDN Certification] NDN certificate issued",
-                      sender = app.config['MAIL_FROM'],
-                      recipients = [cert_request['email']],
-                      body = render_template('cert-issued-email.txt',
-                                             URL=app.config['URL'],
-                                             quoted_cert_name=urllib.parse.quote(cert['name'], ''),
-                                             cert_id=str(data.getName()[-3]),
-                                             **cert_request),
-                      html = render_template('cert-issued-email.html',
-                                             URL=app.config['URL'],
-                                             quoted_cert_name=urllib.parse.quote(cert['name'], ''),
-                                             cert_id=str(data.getName()[-3]),
-                                             **cert_request))
-        mail.send(msg)
-
-        mongo.db.requests.remove(cert_request)
+@app.route('/cert/submit-batch/', methods = ['POST'])
+def submit_certificates():
+    # Batch of decisions is authorized by command interest /cert/submit-batch/<sha256 of decisions>/...
+    commandInterestName, operator = verify_command_interest(request.form['commandInterest'],
+                                                            '/cert/submit-batch', arguments=1)
 
-        return "OK. Certificate has been approved and notification sent to the requester"
+    encodedDecisions = request.form['decisions']
+    if commandInterestName[-5].toEscapedString() != hashlib.sha256(encodedDecisions.encode('utf-8')).hexdigest():
+        abort(403)
+
+    # [{"id": <request id>, "data": <base64-encoded certificate or revocation>}, ...]
+    try:
+        decisionList = json.loads(encodedDecisions)
+    except ValueError:
+        abort(400)
+    if not isinstance(decisionList, list) or \
+       not all(isinstance(decision, dict) and isinstance(decision.get('id'), str) and
+               isinstance(decision.get('data'), str) for decision in decisionList):
+        abort(400)
+
+    results = {}
+    decisions = {}
+    for decision in decisionList:
+        try:
+            wire = base64.b64decode(decision['data'])
+            data = decode_data(wire)
+            decisions[ObjectId(decision['id'])] = (data, wire)
+        except Exception:
+            results[decision['id']] = "invalid decision"
+
+    issued = [] # (request, cert, msg)
+    rejected = [] # (request, msg)
+    for cert_request in mongo.db.requests.find({'_id': {'$in': list(decisions.keys())},
+                                                'operator_id': str(operator['_id'])}):
+        data, wire = decisions[cert_request['_id']]
+        try:
+            cert, msg = make_decision(cert_request, operator, data, wire)
+        except Exception:
+            results[str(cert_request['_id'])] = "invalid decision"
+            continue
+
+        if cert != None:
+            issued.append((cert_request, cert, msg))
+        else:
+            rejected.append((cert_request, msg))
+
+    if len(issued) > 0:
+        try:
+            # unordered, so that one certificate that cannot be stored does not stop the others
+            mongo.db.certs.insert_many([cert for req, cert, msg in issued], ordered=False)
+        except BulkWriteError as e:
+            # requests of certificates that have not been stored stay pending
+            failed = set()
+            for error in e.details['writeErrors']:
+                failed.add(error['index'])
+                results[str(issued[error['index']][0]['_id'])] = "certificate not stored: %s" % \
+                    ("already exists" if error['code'] == 11000 else "database error")
+            issued = [item for i, item in enumerate(issued) if i not in failed]
+        if len(issued) > 0:
+            record_cert_changes(mongo.db, added=[cert['name'] for req, cert, msg in issued])
+
+    processed = [(req, msg) for req, cert, msg in issued] + rejected
+    if len(processed) > 0:
+        outbox.enqueue_many([msg for req, msg in processed])
+        mongo.db.requests.remove({'_id': {'$in': [req['_id'] for req, msg in processed]}})
+    for req, cert, msg in issued:
+        results[str(req['_id'])] = "issue"
+    for req, msg in rejected:
+        results[str(req['_id'])] = "reject"
+
+    for id in decisions.keys():
+        results.setdefault(str(id), "unknown request")
+
+    return jsonify(results)
+
+#############################################################################################
+# Maintenance commands
+#############################################################################################
+
+@app.cli.command('migrate-cert-operators')
+def migrate_cert_operators():
+    """Replace operator records embedded in certificates by operator id and site information"""
+    count = 0
+    for cert in mongo.db.certs.find({'operator': {'$exists': True}}, {'operator': 1}):
+        operator = cert['operator']
+        mongo.db.certs.update({'_id': cert['_id']},
+                              {'$set': {'operator_id': str(operator['_id']),
+                                        'site_prefix': operator['site_prefix'],
+                                        'site_name': operator['site_name']},
+                               '$unset': {'operator': ''}})
+        count += 1
+    print("Updated %d certificates" % count)
+
+@app.cli.command('migrate-binary-certs')
+def migrate_binary_certs():
+    """Store certificates and certification requests of older versions as raw wire encoding"""
+    count = 0
+    for cert in mongo.db.certs.find({'cert': {'$type': 'string'}}, {'cert': 1}):
+        mongo.db.certs.update({'_id': cert['_id']}, {'$set': {'cert': Binary(get_wire(cert))}})
+        count += 1
+    print("Updated %d certificates" % count)
+
+    count = 0
+    for req in mongo.db.requests.find({}, {'cert_request': 1}):
+        wire = get_request_wire(req)
+        if wire != req['cert_request']:
+            mongo.db.requests.update({'_id': req['_id']}, {'$set': {'cert_request': Binary(wire)}})
+            count += 1
+    print("Updated %d certification requests" % count)
+
+def ensure_indexes():
+    """
+    Create indexes that queries of the web server rely on (no-op if they already exist).
+
+    Returns [(collection name, index keys, error)] of indexes that could not be created,
+    e.g., unique indexes over duplicates left by older versions (see `flask
+    remove-duplicate-certs`); the other indexes are created regardless.
+    """
+    failures = []
+    def create(collection, keys, **kwargs):
+        try:
+            collection.create_index(keys, **kwargs)
+        except OperationFailure as e:
+            failures.append((collection.name, keys, e))
+    def create_ttl(collection, field, seconds):
+        try:
+            ensure_ttl_index(collection, field, seconds)
+        except OperationFailure as e:
+            failures.append((collection.name, field, e))
+
+    # /cert/get/, /cert/list/*: certificate lookup by name, expiry filter and sort order
+    create(mongo.db.certs, 'name', unique=True)
+    create(mongo.db.certs, [('name', 1), ('not_after', 1), ('not_before', 1)])
+    # /cert-requests/get/, /wait/: pending requests of the operator in order of submission,
+    # all of them or only guest requests (with site_prefix before created_on, the second
+    # index cannot give all requests of the operator in order)
+    create(mongo.db.requests, [('operator_id', 1), ('created_on', 1)])
+    create(mongo.db.requests, [('operator_id', 1), ('site_prefix', 1), ('created_on', 1)])
+    # /cert-requests/submit/: token lookup (sparse, as tokens of older versions have no hash)
+    create(mongo.db.tokens, 'token_hash', unique=True, sparse=True)
+    create(mongo.db.operators, 'site_prefix', unique=True)
+    # mail-worker: next message to send
+    create(mongo.db.outbox, [('next_attempt', 1), ('attempts', 1)])
+    # /cert/changes: changes after the mirror's version, oldest retained change
+    create(mongo.db.cert_changes, 'seq')
+
+    # unverified tokens and requests that were never processed are removed by the database
+    create_ttl(mongo.db.tokens, 'created_on', app.config.get('TOKEN_TTL'))
+    create_ttl(mongo.db.requests, 'created_on', app.config.get('REQUEST_TTL'))
+    create_ttl(mongo.db.cert_changes, 'created_on', app.config.get('CERT_CHANGES_TTL'))
+    if app.config.get('COMMAND_INTEREST_SHARED_REPLAY_CHECK'):
+        create_ttl(mongo.db.command_interests, 'created_on', int(replay_guard.window))
+    if app.config.get('RATE_LIMIT_SHARED'):
+        # counters are removed as soon as their window is over
+        create(mongo.db.rate_limits, 'expires_on', expireAfterSeconds=0)
+    return failures
+
+def ensure_ttl_index(collection, field, seconds):
+    if not seconds:
+        return
+    try:
+        collection.create_index(field, expireAfterSeconds=seconds)
+    except OperationFailure:
+        # index exists with a different expiration period
+        mongo.db.command('collMod', collection.name,
+                         index={'keyPattern': {field: 1}, 'expireAfterSeconds': seconds})
+
+@app.cli.command('ensure-indexes')
+def ensure_indexes_command():
+    """Create database indexes"""
+    failures = ensure_indexes()
+    for collection, keys, error in failures:
+        print("ERROR: cannot create index %s of %s: %s" % (keys, collection, error))
+    if len(failures) > 0:
+        raise click.ClickException("%d indexes have not been created" % len(failures))
+    print("Indexes are up to date")
+
+@app.cli.command('remove-duplicate-certs')
+@click.option('--dry-run', is_flag=True, help='Only list names of duplicate certificates')
+def remove_duplicate_certs(dry_run):
+    """Keep only the latest of certificates with the same name, as older versions could store"""
+    duplicates = mongo.db.certs.aggregate([
+        {'$group': {'_id': '$name', 'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+        ])
+    names = []
+    removed = 0
+    for duplicate in duplicates:
+        names.append(duplicate['_id'])
+        # ObjectIds increase with the time of insertion
+        ids = sorted(duplicate['ids'])[:-1]
+        print("%s: %d duplicates" % (duplicate['_id'], len(ids)))
+        if not dry_run:
+            removed += mongo.db.certs.delete_many({'_id': {'$in': ids}}).deleted_count
+
+    if not dry_run and len(names) > 0:
+        # mirrors download the certificates that are kept again
+        record_cert_changes(mongo.db, added=names)
+    print("Removed %d certificates" % removed)
+
+@app.cli.command('backfill-cert-validity')
+def backfill_cert_validity():
+    """Store decoded validity period and site prefix in certificates issued before they were recorded"""
+    count = 0
+    for cert in mongo.db.certs.find({'not_after': {'$exists': False}}):
+        notBefore, notAfter = get_validity(decode_certificate(get_wire(cert)))
+        update = {'not_before': notBefore, 'not_after': notAfter}
+        if 'operator' in cert:
+            update['site_prefix'] = cert['operator']['site_prefix']
+        mongo.db.certs.update({'_id': cert['_id']}, {'$set': update})
+        count += 1
+
+    print("Updated %d certificates" % count)
+
+@app.cli.command('mail-worker')
+@click.option('--once', is_flag=True, help='Send queued messages and exit')
+@click.option('--interval', default=5, help='Seconds between checks of an empty queue')
+def mail_worker(once, interval):
+    """Send email messages queued in the outbox"""
+    while True:
+        errors = outbox.errors
+        sent = outbox.drain()
+        if sent > 0 or outbox.errors > errors:
+            stats = outbox.stats()
+            print("Sent %d messages; queue depth %d, failed %d, errors %d, avg send latency %.1f ms" % \
+                  (sent, stats['pending'], stats['failed'], stats['errors'], stats['avg_send_latency'] * 1000))
+        if once:
+            break
+        if sent == 0:
+            time.sleep(interval)
 
 #############################################################################################
 # Helpers
 #############################################################################################
 
 def generate_token():
-    return ''.join([random.choice(string.ascii_letters + string.digits) for n in range(60)])
+    # 60 URL-safe characters
+    return secrets.token_urlsafe(45)
+
+def hash_token(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def find_token(email, token):
+    """Return the token record if the token has been issued for the email, None otherwise"""
+    if not email or not token:
+        return None
+    record = mongo.db.tokens.find_one({'token_hash': hash_token(token)})
+    if record == None or record['email'] != email:
+        return None
+    return record
+
+def get_request_wire(req):
+    """Return wire encoding of the certification request of the request record"""
+    wire = req['cert_request']
+    if isinstance(wire, str):
+        return base64.b64decode(wire)
+    wire = bytes(wire)
+    # wire encoding of Data packet starts with its TLV type (6), base64 can never do;
+    # older versions stored base64 text
+    if wire[:1] != b'\x06':
+        return base64.b64decode(wire)
+    return wire
 
 def ndnify(dnsName):
     ndnName = ndn.Name()
@@ -362,12 +617,196 @@ def ndnify(dnsName):
         ndnName = ndnName.append(str(component))
     return ndnName
 
+# Fields of certification requests that operators can select in /cert-requests/get/
+CANDIDATE_FIELDS = ['operator_id', 'site_prefix', 'assigned_namespace', 'fullname', 'organization',
+                    'email', 'homeurl', 'group', 'advisor', 'cert_request', 'created_on']
+
+def get_candidates_query(operator):
+    """
+    Return (query, projection, limit) selecting operator's certification requests.
+
+    Optional filters: guest_only (requests for operator's guest namespace), since (unix time
+    of the oldest request), limit, fields (comma-separated list of fields to return)
+    """
+    query = {'operator_id': str(operator['_id'])}
+    if request.form.get('guest_only'):
+        query['site_prefix'] = operator['site_prefix']
+    try:
+        if request.form.get('since'):
+            query['created_on'] = {'$gt': datetime.datetime.utcfromtimestamp(float(request.form['since']))}
+        limit = min(int(request.form.get('limit', 0)), app.config.get('CANDIDATES_MAX_LIMIT', 10000))
+    except (ValueError, OverflowError, OSError):
+        # not a number, or a time out of the range of datetime
+        abort(400)
+    if limit <= 0:
+        limit = app.config.get('CANDIDATES_MAX_LIMIT', 10000)
+
+    projection = None
+    if request.form.get('fields'):
+        projection = dict((field, 1) for field in request.form['fields'].split(',')
+                          if field in CANDIDATE_FIELDS)
+
+    return query, projection, limit
+
+def stream_candidates(requests):
+    # encode requests one by one as they are read from the cursor, either as a JSON array
+    # or, with format=ndjson, as one JSON document per line
+    def encode(req):
+        if 'cert_request' in req:
+            # requests stored by older versions, until `flask migrate-binary-certs` is run
+            req['cert_request'] = Binary(get_request_wire(req))
+        return json.dumps(req, default=json_util.default)
+
+    if request.form.get('format') == 'ndjson':
+        def generate():
+            for req in requests:
+                yield encode(req) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    else:
+        def generate():
+            separator = '['
+            for req in requests:
+                yield separator + encode(req)
+                separator = ','
+            yield ']' if separator == ',' else '[]'
+        return Response(stream_with_context(generate()), mimetype='application/json')
+
+@metrics.timed(metrics.ndn_seconds, 'decode_data')
+def decode_data(wire):
+    """Decode Data packet with operator's decision"""
+    data = ndn.Data()
+    # data.wireDecode(ndn.Blob(buffer(wire)))
+    data.wireDecode(ndn.Blob(memoryview(wire)))
+    return data
+
+def verify_command_interest(encodedName, command, arguments=0):
+    """
+    Decode and verify base64-encoded name of operator's command interest
+    (<command>/<arguments>/<timestamp>/<site prefix>/<signature info>/<signature value>),
+    which has to be signed for the given command and number of argument components.
+
+    Returns the decoded name and operator, aborts with 403 if verification fails.
+    """
+    commandInterestName = ndn.Name()
+    commandInterestName.wireDecode(
+        # ndn.Blob(buffer(base64.b64decode(encodedName))))
+        ndn.Blob(base64.b64decode(encodedName)))
+
+    # an interest signed for one command must not be accepted by another
+    command = ndn.Name(command)
+    if commandInterestName.size() != command.size() + arguments + 4 or \
+       not command.isPrefixOf(commandInterestName):
+        abort(403)
+
+    site_prefix = ndn.Name()
+    site_prefix.wireDecode(commandInterestName[-3].getValue().toBuffer())
+    try:
+        timestamp = int(commandInterestName[-4].toEscapedString())
+    except ValueError:
+        abort(403)
+    # milliseconds, as sent by current versions of ndnop-process-requests (older
+    # versions send seconds, and 10**11 seconds are far in the future)
+    precise = timestamp > 10**11
+    if precise:
+        timestamp = timestamp / 1000.0
+
+    # reject stale and replayed interests before spending any effort on them
+    digest = hashlib.sha256(commandInterestName[-1].getValue().toBuffer()).hexdigest()
+    if not replay_guard.check(site_prefix.toUri(), timestamp, digest, precise):
+        abort(403)
+
+    operator = operators.find_by_site_prefix(site_prefix.toUri())
+    if operator == None:
+        replay_guard.failed()
+        abort(403)
+
+    try:
+        keyChain = get_operator_keychain(operator)
+
+        def onVerified(interest):
+            pass
+
+        def onVerifyFailed(interest):
+            raise RuntimeError("Operator verification failed")
+
+        with metrics.ndn_seconds.time('verify_command_interest'):
+            keyChain.verifyInterest(ndn.Interest(commandInterestName), onVerified, onVerifyFailed, stepCount=1)
+    except Exception as e:
+        app.logger.warning("Command interest of %s not verified: %s", site_prefix.toUri(), e)
+        replay_guard.failed()
+        abort(403)
+
+    if not replay_guard.record(site_prefix.toUri(), timestamp, digest, precise):
+        abort(403)
+
+    return commandInterestName, operator
+
+def make_decision(cert_request, operator, data, wire):
+    """
+    Prepare the outcome of operator's decision on the certification request.
+
+    Returns the certificate record to store (None if the request has been denied)
+    and the notification message for the requester.
+    """
+    if len(data.getContent()) == 0:
+        # (no deny reason for now)
+        # eventually, need to check data.type: if NACK, then content contains reason for denial
+        #                                      if KEY, then content is the certificate
+
+        msg = Message("[NDN Certification] Rejected certification",
+                      sender = app.config['MAIL_FROM'],
+                      recipients = [cert_request['email']],
+                      body = render_template('cert-rejected-email.txt',
+                                             URL=app.config['URL'], **cert_request),
+                      html = render_template('cert-rejected-email.html',
+                                             URL=app.config['URL'], **cert_request))
+        return None, msg
+
+    notBefore, notAfter = get_validity(decode_certificate(wire))
+    cert = {
+        'name': data.getName().toUri(),
+        'cert': Binary(wire),
+        'operator_id': str(operator['_id']),
+        'site_prefix': operator['site_prefix'],
+        'site_name': operator['site_name'],
+        'not_before': notBefore,
+        'not_after': notAfter,
+        'created_on': datetime.datetime.utcnow(), # to periodically remove unverified tokens
+        }
+
+    msg = Message("[NDN Certification] NDN certificate issued",
+                  sender = app.config['MAIL_FROM'],
+                  recipients = [cert_request['email']],
+                  body = render_template('cert-issued-email.txt',
+                                         URL=app.config['URL'],
+                                         quoted_cert_name=urllib.parse.quote(cert['name'], ''),
+                                         cert_id=str(data.getName()[-3]),
+                                         **cert_request),
+                  html = render_template('cert-issued-email.html',
+                                         URL=app.config['URL'],
+                                         quoted_cert_name=urllib.parse.quote(cert['name'], ''),
+                                         cert_id=str(data.getName()[-3]),
+                                         **cert_request))
+    return cert, msg
+
+# KeyChains verifying operator command interests, keyed by operator id and hash of the
+# operator's certificate, so that changing the certificate in admin interface takes effect
+operator_keychains = LRUCache('operator_keychains', 256)
+
+def get_operator_keychain(operator):
+    key = (str(operator['_id']), hashlib.sha256((operator.get('key') or '').encode('utf-8')).hexdigest())
+    keyChain = operator_keychains.get(key)
+    if keyChain == None:
+        keyChain = KeyChain(policyManager = OperatorVerifyPolicyManager(operator))
+        operator_keychains.put(key, keyChain)
+    return keyChain
+
 def get_operator_for_email(email):
     # very basic pre-validation
     user, domain = email.split('@', 2)
-    operator = mongo.db.operators.find_one({'site_emails': {'$in':[ domain ]}})
+    operator = operators.find_by_domain(domain)
     if (operator == None):
-        operator = mongo.db.operators.find_one({'site_emails': {'$in':[ 'guest' ]}})
+        operator = operators.find_guest()
 
         if (operator == None):
             raise Exception("Unknown site for domain [%s]" % domain)
@@ -381,19 +820,50 @@ def get_operator_for_email(email):
             ndn_domain = ndn.Name(str(user))
             assigned_namespace = ndn.Name(str(user))
         else:
+            # namespace of user@domain is the prefix of namespaces of all users of the domain
+            # user.domain, so it cannot be assigned if that domain is listed by an operator
+            # (subdomains covered by allowSubdomains are only known from their requests and certificates)
+            if operators.find_by_domain('%s.%s' % (user, domain), exact=True) != None:
+                raise Exception("Namespace of [%s] is reserved for domain [%s.%s]" % (email, user, domain))
+
             ndn_domain = ndnify(domain)
             assigned_namespace = ndn.Name('/ndn')
             assigned_namespace \
                 .append(ndn_domain) \
                 .append(str(user))
 
+            # ...nor if users of that subdomain have already used it
+            if operator.get('allowSubdomains') and \
+               subdomain_in_use(operator, '%s.%s' % (user, domain), assigned_namespace):
+                raise Exception("Namespace of [%s] is used by domain [%s.%s]" % (email, user, domain))
+
     # return various things
     return {'operator':operator, 'user':user, 'domain':domain, 'requestDetails':True,
             'ndn_domain':ndn_domain, 'assigned_namespace':assigned_namespace}
 
+def subdomain_in_use(operator, subdomain, namespace):
+    """
+    Return True if operator's certification requests from the subdomain (or its subdomains),
+    or certificates of identities under the namespace other than its own, exist
+    """
+    if mongo.db.requests.find_one({'operator_id': str(operator['_id']),
+                                   'email': {'$regex': '[@.]%s$' % re.escape(subdomain), '$options': 'i'}},
+                                  {'_id': 1}) != None:
+        return True
+
+    # KEY is inserted into certificate names after the namespace of the signer; the
+    # namespace's own certificates have just the key id between it and ID-CERT
+    components = [namespace[i].toEscapedString() for i in range(namespace.size())]
+    for i in range(1, len(components) + 1):
+        prefix = '/' + '/'.join(components[:i] + ['KEY'] + components[i:])
+        if mongo.db.certs.find_one({'name': {'$regex': '^%s(/[^/]+){2,}/ID-CERT/' % re.escape(prefix)}},
+                                   {'_id': 1}) != None:
+            return True
+    return False
+
 def get_operator_for_guest_site(email, site_prefix):
-    operator = mongo.db.operators.find_one({'site_prefix': site_prefix, 'allowGuests': True})
-    if (operator == None):
+    operator = operators.find_by_site_prefix(site_prefix)
+    if (operator == None or not operator.get('allowGuests')):
         raise Exception("Invalid site")
 
     assigned_namespace = ndn.Name(site_prefix)
@@ -405,5 +875,15 @@ def get_operator_for_guest_site(email, site_prefix):
     return {'operator':operator, 'user':None, 'domain':None, 'requestDetails':False,
             'ndn_domain':site_prefix, 'assigned_namespace':assigned_namespace}
 
+if app.config.get('ENSURE_INDEXES_ON_STARTUP', False):
+    with app.app_context():
+        # the server works without the indexes, only slower
+        try:
+            for collection, keys, error in ensure_indexes():
+                app.logger.error("Cannot create index %s of %s: %s", keys, collection, error)
+        except PyMongoError as e:
+            # e.g., database not reachable
+            app.logger.error("Cannot create database indexes, run `flask ensure-indexes`: %s", e)
+
 if __name__ == '__main__':
     app.run(debug = True, host='0.0.0.0')
@@ -3,6 +3,71 @@
 ####################
 URL = "http://ndncert.named-data.net"
 
+# Maximum number of decoded certificates kept in memory for /cert/get/?view=1
+CERT_CACHE_SIZE = 1024
+
+# Cache-Control max-age (seconds) for certificate downloads and lists
+CERT_CACHE_MAX_AGE = 60
+
+# Number of certificates per page of HTML certificate lists (default and upper bound)
+CERT_LIST_PAGE_SIZE = 500
+CERT_LIST_MAX_PAGE_SIZE = 5000
+
+# Maximum number of certificates returned by one /cert/changes call, and how long (seconds)
+# a gap in change numbers is waited for before later changes are returned
+CERT_CHANGES_MAX = 5000
+CERT_CHANGES_SETTLE_TIME = 60
+
+# How often (seconds) each server process checks whether the operators have been changed
+OPERATOR_CACHE_CHECK_INTERVAL = 5
+
+# Maximum difference (seconds) between the timestamp of operator command interest and the
+# current time.  Older versions of ndnop-process-requests stamp local time as if it were UTC,
+# hence the default tolerates any time zone offset.
+COMMAND_INTEREST_WINDOW = 15 * 3600
+# Same for command interests with millisecond timestamps, as stamped by current versions
+COMMAND_INTEREST_PRECISE_WINDOW = 5 * 60
+# Number of signatures of recent command interests remembered to detect replays
+COMMAND_INTEREST_MAX_SEEN = 100000
+# Also remember signatures in the database, to detect replays across server processes.
+# Without it, each process only knows interests it has verified itself, so an interest
+# captured within the window can be replayed once against every other server process.
+COMMAND_INTEREST_SHARED_REPLAY_CHECK = True
+
+# Maximum number of certification requests returned to the operator at once
+CANDIDATES_MAX_LIMIT = 10000
+# Longest wait (seconds) for new requests in /cert-requests/wait/ and how often the database
+# is checked meanwhile.  Waiting occupies a server worker, so threaded or asynchronous
+# workers are needed when operators use `ndnop-process-requests --watch`.
+CANDIDATES_WAIT_MAX_TIMEOUT = 60
+CANDIDATES_WAIT_POLL_INTERVAL = 1
+
+# Rate limits of user-facing routes as (requests per second, burst), per client address
+# (use werkzeug's ProxyFix when running behind a proxy) or per email address
+RATE_LIMITS = {
+    'token-address': (1.0 / 60, 10),  # token requests
+    'token-email': (1.0 / 600, 3),    # confirmation emails sent to one address
+    'submit-address': (1.0 / 10, 30), # certification request forms and submissions
+    }
+# Share rate limit counters between server processes through the database
+RATE_LIMIT_SHARED = False
+
+#####################
+# Database settings #
+#####################
+
+# Create database indexes when the server starts, rather than with `flask ensure-indexes`
+# after each upgrade (building indexes of large collections delays the start of every worker)
+ENSURE_INDEXES_ON_STARTUP = False
+
+# Seconds after which unused email confirmation tokens and unprocessed certification
+# requests are removed from the database (None to keep them forever)
+TOKEN_TTL = 7 * 24 * 3600
+REQUEST_TTL = 90 * 24 * 3600
+# Seconds after which recorded certificate changes are removed; mirrors that have not
+# synchronized for longer have to download /cert/snapshot again
+CERT_CHANGES_TTL = 90 * 24 * 3600
+
 #################
 # SMTP settings #
 #################
@@ -13,3 +78,8 @@ MAIL_PORT = 25
 # MAIL_USERNAME = ''
 # MAIL_PASSWORD = ''
 # MAIL_USE_SSL = True
+
+# Messages are queued in the database and sent by `flask mail-worker`; failed messages
+# are retried after MAIL_RETRY_DELAY seconds, doubling the delay on each attempt
+MAIL_MAX_ATTEMPTS = 8
+MAIL_RETRY_DELAY = 60